@@ -0,0 +1,70 @@
+# Compares the old regex-based table scraping against html_tables' streaming extractor.
+# Usage: python benchmarks/bench_html_tables.py [saved_page.html ...]
+# Without arguments, this generates synthetic pages shaped like the ones we scrape (a large page with the history table in the middle).
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import html_tables
+
+FIND_TABLE       = re.compile('<table[^>]*>(.*?)</table>')
+FIND_TABLE_ROWS  = re.compile('<tr[^>]*>(.*?)</tr>')
+FIND_TABLE_CELLS = re.compile('<td[^>]*>(.*?)</td>')
+
+CHUNK_SIZE = 16 * 1024
+
+def regex_rows(text, table_index):
+  table = FIND_TABLE.findall(text)[table_index]
+  rows = []
+  for row in FIND_TABLE_ROWS.findall(table):
+    cells = FIND_TABLE_CELLS.findall(row)
+    if cells:
+      rows.append(cells)
+  return rows
+
+def streaming_rows(text, table_index, max_rows):
+  consumed = 0
+  def chunks():
+    nonlocal consumed
+    for i in range(0, len(text), CHUNK_SIZE):
+      consumed += CHUNK_SIZE
+      yield text[i:i+CHUNK_SIZE]
+  rows = list(html_tables.iter_table_rows(chunks(), table_index, max_rows))
+  return rows, min(consumed, len(text))
+
+def synthetic_page(header_kb, footer_kb, rows=100):
+  header = '<html><head><script>' + 'var x = 1;' * (header_kb * 100) + '</script></head><body>'
+  header += '<table class="nav"><tr><td>Menu</td></tr></table>'
+  table = '<table class="history"><thead><tr><th>Date</th><th>Open</th></tr></thead><tbody>'
+  for i in range(rows):
+    table += f'<tr><td><time dateTime="May {i % 28 + 1:02}, 2024">05/{i % 28 + 1:02}/2024</time></td><td>3{i % 10},123.45</td><td>3{i % 10},100.00</td></tr>'
+  table += '</tbody></table>'
+  footer = '<div>' + '<p>Lorem ipsum dolor sit amet</p>' * (footer_kb * 30) + '</div></body></html>'
+  return header + table + footer
+
+def bench(func, *args, repeat=20):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = func(*args)
+  return (time.perf_counter() - start) / repeat * 1000, result
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    pages = {}
+    for path in sys.argv[1:]:
+      with open(path, 'r', encoding='utf-8') as f:
+        pages[os.path.basename(path)] = f.read()
+  else:
+    pages = {
+      'synthetic-small': synthetic_page(50, 50),
+      'synthetic-large': synthetic_page(300, 200),
+      'synthetic-late-table': synthetic_page(800, 10),
+    }
+
+  print(f'{"page":<24} {"size":>9} {"regex ms":>9} {"stream ms":>9} {"read":>9}')
+  for name, text in pages.items():
+    regex_ms, _ = bench(regex_rows, text, 1)
+    stream_ms, (_, consumed) = bench(streaming_rows, text, 1, 10)
+    print(f'{name:<24} {len(text):>9} {regex_ms:>9.2f} {stream_ms:>9.2f} {consumed:>9}')
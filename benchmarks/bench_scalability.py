@@ -0,0 +1,215 @@
+# Scalability benchmarks for the daily run, using synthetic config pages at several scales.
+# Usage: python benchmarks/bench_scalability.py [--scales 100,1000,10000] [--latency 0.001] [--output results.jsonl]
+#        python benchmarks/bench_scalability.py --compare results.jsonl
+#
+# Each phase is run twice: once for wall time, and once under tracemalloc for allocations and peak memory
+# (tracemalloc slows everything down, so the timings would be meaningless otherwise).
+# The 'main' phase is a whole run, and also records the time of each of its own phases (fetch, parse, match, render, dispatch)
+# from instrumentation (stages which run on several workers add up the time on each, so they can exceed the wall time).
+# The other phases are micro-benchmarks of the steps which scale with the number of pages.
+# Results are appended as JSON lines, tagged with the current commit, so that runs from different commits can be compared.
+import argparse
+import collections
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import dispatch
+import dow_jones
+import instrumentation
+import main
+import tests
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'results.jsonl')
+
+# A Friday, so that the run covers the whole weekend
+TODAY = datetime.datetime(2020, 1, 3, 13, 30, tzinfo=datetime.timezone.utc)
+DOW_OPENS = [(datetime.datetime(2020, 1, 2), '28638.97'), (datetime.datetime(2020, 1, 3), '28634.88')]
+
+class SlowWiki(tests.MockWiki):
+  # MockWiki, but every API call takes `latency` seconds, like a (fast) real wiki would
+  def __init__(self, latency):
+    super().__init__()
+    self.latency = latency
+
+  def get(self, action, **kwargs):
+    time.sleep(self.latency)
+    return super().get(action, **kwargs)
+
+  def email_user(self, user, title, contents, **kwargs):
+    time.sleep(self.latency)
+    return super().email_user(user, title, contents, **kwargs)
+
+class SlowPage(tests.MockPage):
+  def get_wiki_text(self):
+    if self.wiki:
+      time.sleep(self.wiki.latency)
+    return super().get_wiki_text()
+
+  def edit(self, contents, **kwargs):
+    if self.wiki:
+      time.sleep(self.wiki.latency)
+    return super().edit(contents, **kwargs)
+
+def synthetic_config(rng, graticules, density):
+  # One line per graticule, each with `density` random centicules and a random selection of settings.
+  lines = ['{| class="wikitable"', '! Lat !! Lon !! Centicules !! !! Settings']
+  for _ in range(graticules):
+    lat, long = rng.randint(-89, 89), rng.randint(-179, 179)
+    cents = ' '.join(f'{cent:02}' for cent in sorted(rng.sample(range(100), density)))
+    settings = rng.sample(main.DAY_OF_WEEK, rng.randint(0, 3)) + rng.sample(['email', 'talkpage'], rng.randint(0, 2))
+    if rng.random() < 0.1:
+      settings.append(f'radius={rng.randint(5, 100)}km@{lat}.{rng.randint(0, 99):02}/{long}.{rng.randint(0, 99):02}')
+    if rng.random() < 0.05:
+      settings.append('globalhash')
+    lines.append('|-')
+    lines.append(f'| {lat} || {long} || {cents} || || {", ".join(settings)}')
+  lines.append('|}')
+  return '\n'.join(lines)
+
+def synthetic_pages(wiki, scale, graticules, density, seed=0):
+  rng = random.Random(seed)
+  pages = []
+  for i in range(scale):
+    page = SlowPage(wiki, f'User:Bench{i // 3}/Config {i}') # Most users have a few config pages
+    page.wikitext = synthetic_config(rng, graticules, density)
+    pages.append(page)
+  return pages
+
+def run_main(wiki):
+  # Fresh state for every run, so that nothing is skipped by the cache or the journal (and nothing is written to the checkout)
+  state = tempfile.mkdtemp()
+  main.DOW_HISTORY_PATH = os.path.join(state, 'dow_history.bin')
+  main.PAGE_CACHE_PATH = os.path.join(state, 'page_cache.json')
+  main.RUN_JOURNAL_PATH = os.path.join(state, 'run_journal.jsonl')
+  main.HASH_COVERAGE_PATH = os.path.join(state, 'hash_coverage.json')
+  main.SOURCE_HEALTH_PATH = os.path.join(state, 'source_health.json')
+  main.main(wiki, TODAY)
+
+def measure(func):
+  start = time.perf_counter()
+  func()
+  wall = time.perf_counter() - start
+
+  tracemalloc.start()
+  try:
+    before = tracemalloc.take_snapshot()
+    func()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename') if stat.size_diff > 0)
+  blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+  return {'wall_s': round(wall, 4), 'retained_kb': round(allocated / 1024, 1), 'retained_blocks': blocks, 'peak_kb': round(peak / 1024, 1)}
+
+def get_commit():
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return commit + ('-dirty' if dirty else '')
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_benchmarks(scales, graticules, density, latency):
+  # Edits are rate limited to 1/second in production, which would just measure the rate limit.
+  main.dispatch.Dispatcher = functools.partial(dispatch.Dispatcher, rate=1e9, burst=1e9)
+  main.Page = SlowPage
+  dow_jones.dow_sources = [lambda: DOW_OPENS] * 3
+
+  for scale in scales:
+    wiki = SlowWiki(latency)
+    wiki.category_pages = synthetic_pages(wiki, scale, graticules, density)
+    texts = [page.wikitext for page in wiki.category_pages]
+    configs = [main.parse_config(text) for text in texts]
+    dow_opens = {day.strftime('%Y-%m-%d'): dow_open for day, dow_open in DOW_OPENS}
+    days = [TODAY + datetime.timedelta(days=i) for i in range(3)]
+
+    def get_geohashes():
+      # The old per-subscription pattern, as a baseline for the GeohashTable
+      for config in configs:
+        for (lat, long) in config.graticules:
+          for day in days:
+            main.get_geohash(dow_opens, day, int(long) < -30)
+
+    run_timers = [] # From each run of main, the first of which is the one timed by measure()
+    def run_timed_main():
+      instrumentation.reset()
+      run_main(wiki)
+      run_timers.append({path: timer['seconds'] for path, timer in instrumentation.summary()['timers'].items()})
+
+    phases = {
+      'parse_config': lambda: [main.parse_config(text) for text in texts],
+      'get_geohash': get_geohashes,
+      'geohash_table': lambda: main.GeohashTable(dow_opens, days),
+      'main': run_timed_main,
+    }
+    for phase, func in phases.items():
+      wiki.edits.clear()
+      wiki.emails.clear()
+      result = measure(func)
+      if phase == 'main':
+        result['edits'] = len(wiki.edits) // 2 # Two runs
+        result['emails'] = len(wiki.emails) // 2
+        result['timers'] = run_timers[0]
+      yield {'scale': scale, 'phase': phase, **result}
+
+def compare(path):
+  # Shows the two most recent commits side by side
+  results = collections.defaultdict(dict) # commit: (scale, phase): result
+  with open(path, 'r', encoding='utf-8') as f:
+    for line in f:
+      result = json.loads(line)
+      results[result['commit']][(result['scale'], result['phase'])] = result
+  commits = list(results)[-2:]
+  if len(commits) < 2:
+    print(f'Need results from at least two commits to compare, found {len(commits)}')
+    return
+  old, new = commits
+  print(f'{"scale":>6} {"phase":<14} {old + " s":>16} {new + " s":>16} {"change":>8} {"peak KB":>10}')
+  for key, result in results[new].items():
+    if key not in results[old]:
+      continue
+    before, after = results[old][key]['wall_s'], result['wall_s']
+    change = f'{(after - before) / before * 100:+.0f}%' if before else ''
+    print(f'{key[0]:>6} {key[1]:<14} {before:>16.4f} {after:>16.4f} {change:>8} {result["peak_kb"]:>10}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--scales', default='100,1000,10000', help='Comma-separated numbers of config pages')
+  parser.add_argument('--graticules', type=int, default=5, help='Graticules per config page')
+  parser.add_argument('--density', type=int, default=30, help='Centicules per graticule')
+  parser.add_argument('--latency', type=float, default=0.001, help='Seconds per wiki API call')
+  parser.add_argument('--output', default=DEFAULT_OUTPUT)
+  parser.add_argument('--compare', metavar='RESULTS', help='Compare the last two commits in a results file, instead of running')
+  args = parser.parse_args()
+
+  if args.compare:
+    compare(args.compare)
+    sys.exit(0)
+
+  run = {
+    'commit': get_commit(),
+    'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'graticules': args.graticules,
+    'density': args.density,
+    'latency': args.latency,
+  }
+  with open(args.output, 'a', encoding='utf-8') as f:
+    for result in run_benchmarks([int(scale) for scale in args.scales.split(',')], args.graticules, args.density, args.latency):
+      print(f'{result["scale"]:>6} {result["phase"]:<14} {result["wall_s"]:>9.4f}s {result["peak_kb"]:>10} KB peak')
+      for path, seconds in result.get('timers', {}).items():
+        print(f'{"":>6}   {path:<24} {seconds:>9.4f}s')
+      f.write(json.dumps({**run, **result}) + '\n')
+      f.flush()
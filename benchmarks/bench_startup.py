@@ -0,0 +1,88 @@
+# Startup cost of the bot's entry points, from python -X importtime, and the wall time of a run on a day when the market
+# is closed (which should do nothing but import, check the calendar, and exit).
+# Usage: python benchmarks/bench_startup.py [--runs 5] [--top 8] [--output results.jsonl]
+#
+# Each measurement is a fresh interpreter, so this includes everything a real invocation pays for.
+# Times are the median over all runs, minus the cost of starting python itself.
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_scalability import get_commit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'startup_results.jsonl')
+
+ENTRY_POINTS = {
+  'main': 'import main',
+  'server': 'import server',
+  'bulk_geohash': 'import bulk_geohash',
+  'dow_jones': 'import dow_jones',
+  # A Saturday, so main() returns straight away
+  'weekend_run': 'import datetime, main; main.main(None, datetime.datetime(2024, 5, 4, 13, 30))',
+}
+
+# These should only be loaded on the paths which actually use them
+HEAVY_MODULES = ['requests', 'urllib3', 'zoneinfo', 'TFWiki-scripts.wikitools.wiki']
+
+def run_python(code, importtime=False):
+  # Returns (wall seconds, {module: (cumulative import microseconds, nesting level)})
+  args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+  env = {**os.environ, 'PYTHONPATH': os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')])}
+  start = time.perf_counter()
+  result = subprocess.run(args, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+  wall = time.perf_counter() - start
+
+  imports = {}
+  for line in result.stderr.splitlines():
+    # import time: self [us] | cumulative | imported package
+    if not line.startswith('import time:') or 'imported package' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    level = (len(name) - len(name.lstrip()) - 1) // 2 # Nested imports are indented two spaces per level
+    imports[name.strip()] = (int(cumulative), level)
+  return wall, imports
+
+def run_benchmarks(runs, top):
+  baseline = statistics.median(run_python('pass')[0] for _ in range(runs))
+  startup_imports = run_python('pass', importtime=True)[1] # e.g. site, which every interpreter loads
+  print(f'Python startup: {baseline * 1000:.1f} ms (subtracted from the times below)')
+
+  for name, code in ENTRY_POINTS.items():
+    # importtime adds some overhead of its own, so the wall time is measured separately
+    wall = statistics.median(run_python(code)[0] for _ in range(runs)) - baseline
+    _, imports = run_python(code, importtime=True)
+    imports = {module: us for module, us in imports.items() if module not in startup_imports}
+    heavy = [module for module in HEAVY_MODULES if module in imports]
+    # Nested imports are already counted in their parent's cumulative time
+    total = sum(us for us, level in imports.values() if level == 0)
+    slowest = {module: us for module, (us, _) in sorted(imports.items(), key=lambda item: item[1][0], reverse=True)[:top]}
+
+    print(f'\n{name}: {wall * 1000:.1f} ms, {total / 1000:.1f} ms importing')
+    if heavy:
+      print(f'  Loaded: {", ".join(heavy)}')
+    for module, us in slowest.items():
+      print(f'  {us / 1000:>8.1f} ms  {module}')
+    yield {'entry_point': name, 'wall_ms': round(wall * 1000, 2), 'modules': len(imports), 'import_ms': round(total / 1000, 2), 'heavy_modules': heavy, 'slowest': slowest}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--top', type=int, default=8, help='Slowest imports to show for each entry point')
+  parser.add_argument('--output', default=DEFAULT_OUTPUT)
+  args = parser.parse_args()
+
+  run = {
+    'commit': get_commit(),
+    'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+  }
+  with open(args.output, 'a', encoding='utf-8') as f:
+    for result in run_benchmarks(args.runs, args.top):
+      f.write(json.dumps({**run, **result}) + '\n')
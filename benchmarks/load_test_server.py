@@ -0,0 +1,97 @@
+# Load test for server.py. Each client thread keeps one connection open and sends requests back to back.
+# Usage: python benchmarks/load_test_server.py [http://host:port] [--clients N] [--seconds N]
+# Without a URL, this starts a local server in-process, backed by a synthetic DOW history.
+# Most requests are for recent dates (which is what real clients ask for), with some for random older dates to exercise cache misses.
+import argparse
+import datetime
+import http.client
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import dow_history
+import server
+
+def synthetic_history(path, years=20):
+  today = datetime.date.today()
+  day = today - datetime.timedelta(days=365 * years)
+  with dow_history.DowHistory(path) as history:
+    while day <= today:
+      if day.weekday() < 5:
+        history.add(day.isoformat(), f'{random.randint(10000, 40000)}.{random.randint(0, 99):02}')
+      day += datetime.timedelta(days=1)
+
+def random_path(rng, today):
+  if rng.random() < 0.9:
+    date = today - datetime.timedelta(days=rng.randint(0, 7))
+  else:
+    date = today - datetime.timedelta(days=rng.randint(0, 365 * 15))
+  lat, lon = rng.randint(-89, 89), rng.randint(-179, 179)
+  endpoint = rng.choice(['/geohash', '/geohash', '/centicule', '/globalhash'])
+  return f'{endpoint}?date={date}&lat={lat}&lon={lon}'
+
+def client(host, port, deadline, seed, latencies, errors):
+  rng = random.Random(seed)
+  today = datetime.date.today()
+  connection = http.client.HTTPConnection(host, port)
+  while time.perf_counter() < deadline:
+    start = time.perf_counter()
+    try:
+      connection.request('GET', random_path(rng, today))
+      response = connection.getresponse()
+      response.read()
+      if response.status not in [200, 404]: # 404 is expected for dates without an open
+        errors.append(response.status)
+    except (OSError, http.client.HTTPException) as e:
+      errors.append(e)
+      connection.close()
+      connection = http.client.HTTPConnection(host, port)
+      continue
+    latencies.append(time.perf_counter() - start)
+  connection.close()
+
+def percentile(values, p):
+  return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('url', nargs='?')
+  parser.add_argument('--clients', type=int, default=16)
+  parser.add_argument('--seconds', type=float, default=10)
+  args = parser.parse_args()
+
+  local_server = None
+  if args.url:
+    url = urllib.parse.urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+  else:
+    path = os.path.join(tempfile.mkdtemp(), 'dow_history.bin')
+    synthetic_history(path)
+    history = dow_history.DowHistory(path)
+    local_server = server.GeohashServer(('127.0.0.1', 0), history)
+    threading.Thread(target=local_server.serve_forever, daemon=True).start()
+    host, port = local_server.server_address
+
+  latencies = [] # list.append is atomic, so the clients can share these
+  errors = []
+  deadline = time.perf_counter() + args.seconds
+  threads = [threading.Thread(target=client, args=(host, port, deadline, i, latencies, errors)) for i in range(args.clients)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if local_server:
+    local_server.shutdown()
+    local_server.server_close()
+    history.close()
+
+  latencies.sort()
+  print(f'{len(latencies)} requests from {args.clients} clients in {args.seconds}s: {len(latencies) / args.seconds:.0f} req/s, {len(errors)} errors')
+  if latencies:
+    print(f'latency ms: p50 {percentile(latencies, 50) * 1000:.2f}, p90 {percentile(latencies, 90) * 1000:.2f}, p99 {percentile(latencies, 99) * 1000:.2f}')
@@ -0,0 +1,132 @@
+import array
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import math
+import sys
+
+import main
+
+# Batch geohash computation for long date ranges (backfills, statistics, etc).
+# The output matches main.get_geohash exactly, but each distinct hash string is only computed once,
+# and the coordinates are kept as floats in flat arrays rather than formatted strings.
+
+# One set of arrays per rule (W30 / E30), indexed the same as BulkGeohashes.days.
+# Days without a known DOW open have NaN coordinates and a centicule of None.
+HashArrays = collections.namedtuple('HashArrays', ['latitude', 'longitude', 'centicule'])
+
+PROCESS_THRESHOLD = 500000 # Distinct hashes. MD5 takes about a microsecond, so below this, starting a process pool takes longer than the hashing.
+
+def hash_chunk(hash_strings):
+  latitudes = array.array('d')
+  longitudes = array.array('d')
+  for hash_string in hash_strings:
+    hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
+    latitudes.append(float.fromhex(f'0.{hash[:16]}'))
+    longitudes.append(float.fromhex(f'0.{hash[16:]}'))
+  return latitudes, longitudes
+
+class BulkGeohashes:
+  def __init__(self, days, w30, e30):
+    self.days = days
+    self.w30 = w30
+    self.e30 = e30
+
+  def __len__(self):
+    return len(self.days)
+
+  # Same return value as main.get_geohash, for the i-th day
+  def get(self, i, w30 = True):
+    hashes = self.w30 if w30 else self.e30
+    if hashes.centicule[i] is None:
+      return None
+    return (str(hashes.latitude[i])[2:], str(hashes.longitude[i])[2:], hashes.centicule[i])
+
+def resolve_opens(dow_opens, days):
+  # Returns {w30: [DOW open, or None]} for each day, the same as main.get_dow_open, in one forward pass over the dates
+  # (rather than ten lookups and strftime calls per day and rule). days must be consecutive.
+  first = days[0].toordinal() - 10 # get_dow_open looks back 9 days, and E30 one more than that
+  w30_rule_start = main.W30_RULE_START.toordinal()
+  latest = [] # For each ordinal from first, (ordinal, open) of the last known open on or before it
+  last = (None, None)
+  for ordinal in range(first, days[-1].toordinal() + 1):
+    if dow_open := dow_opens.get(datetime.date.fromordinal(ordinal).isoformat()):
+      last = (ordinal, dow_open)
+    latest.append(last)
+
+  # get_dow_open looks at the 10 days up to this one, each shifted back a day for E30 after the 30W rule started.
+  def shift(ordinal, w30):
+    return ordinal - 1 if not w30 and ordinal >= w30_rule_start else ordinal
+
+  opens = {True: [], False: []}
+  for day in days:
+    ordinal = day.toordinal()
+    for w30 in [True, False]:
+      open_ordinal, dow_open = latest[shift(ordinal, w30) - first]
+      opens[w30].append(dow_open if open_ordinal is not None and open_ordinal >= shift(ordinal - 9, w30) else None)
+  return opens
+
+def get_geohashes(dow_opens, start, end, workers=None, chunk_size=4096):
+  # Computes geohashes for every day in [start, end], inclusive. If workers is set and there are more than
+  # PROCESS_THRESHOLD distinct hashes, the hashing is split across a process pool.
+  days = []
+  day = datetime.datetime(start.year, start.month, start.day, tzinfo=datetime.timezone.utc)
+  while day.date() <= end:
+    days.append(day)
+    day += datetime.timedelta(days=1)
+
+  # Many of these are duplicates (on weekends, and before the 30W rule existed), so only hash each string once.
+  hash_strings = {}
+  keys = {True: [], False: []}
+  for w30, opens in resolve_opens(dow_opens, days).items():
+    for day, dow_open in zip(days, opens):
+      if not dow_open:
+        keys[w30].append(None)
+        continue
+      hash_string = day.date().isoformat() + '-' + dow_open
+      keys[w30].append(hash_strings.setdefault(hash_string, len(hash_strings)))
+
+  hash_strings = list(hash_strings)
+  chunks = [hash_strings[i:i+chunk_size] for i in range(0, len(hash_strings), chunk_size)]
+  latitudes = array.array('d')
+  longitudes = array.array('d')
+  if workers and len(chunks) > 1 and len(hash_strings) > PROCESS_THRESHOLD:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(hash_chunk, chunks))
+  else:
+    results = map(hash_chunk, chunks)
+  for chunk_latitudes, chunk_longitudes in results:
+    latitudes.extend(chunk_latitudes)
+    longitudes.extend(chunk_longitudes)
+
+  arrays = {}
+  for w30 in [True, False]:
+    hashes = HashArrays(array.array('d'), array.array('d'), [])
+    for key in keys[w30]:
+      if key is None:
+        hashes.latitude.append(math.nan)
+        hashes.longitude.append(math.nan)
+        hashes.centicule.append(None)
+      else:
+        hashes.latitude.append(latitudes[key])
+        hashes.longitude.append(longitudes[key])
+        # Derived from the formatted strings (rather than the floats) to match main.get_geohash exactly
+        hashes.centicule.append(str(latitudes[key])[2] + str(longitudes[key])[2])
+    arrays[w30] = hashes
+
+  return BulkGeohashes(days, arrays[True], arrays[False])
+
+if __name__ == '__main__':
+  # Usage: python bulk_geohash.py dow_history.bin 2020-01-01 2020-12-31 > geohashes.csv
+  import dow_history
+  with dow_history.DowHistory(sys.argv[1]) as history:
+    start = datetime.date.fromisoformat(sys.argv[2])
+    end = datetime.date.fromisoformat(sys.argv[3])
+    geohashes = get_geohashes(history, start, end, workers=4)
+
+  print('date,w30_latitude,w30_longitude,w30_centicule,e30_latitude,e30_longitude,e30_centicule')
+  for i, day in enumerate(geohashes.days):
+    w30 = geohashes.get(i, w30=True) or ('', '', '')
+    e30 = geohashes.get(i, w30=False) or ('', '', '')
+    print(day.strftime('%Y-%m-%d'), *w30, *e30, sep=',')
@@ -0,0 +1,128 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+import instrumentation
+
+verbose = False
+
+# Runs wiki edits (and emails) on a small worker pool, so that one slow request doesn't hold up the rest of the run.
+# Jobs with the same key (i.e. the same page) are run in order on the same worker, so they can never conflict with each other.
+# run and on_success are called with no arguments. on_success is called once run has succeeded (e.g. to record it in the journal).
+Job = collections.namedtuple('Job', ['key', 'description', 'run', 'on_success'], defaults=[None])
+
+# Errors from the MediaWiki API which mean 'try again later', see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+RETRY_CODES = ['maxlag', 'ratelimited', 'readonly']
+MAXLAG = 5 # Seconds. Sent with every edit and email, so the wiki refuses them (with a maxlag error) while its replicas are behind.
+
+class Retry(Exception):
+  def __init__(self, message, retry_after=None):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+class TokenBucket:
+  # Allows bursts of up to `capacity` calls, refilling at `rate` calls per second.
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+def parse_retry_after(value):
+  try:
+    return max(float(value), 0)
+  except (TypeError, ValueError):
+    return None
+
+def check_result(result):
+  # The API reports maxlag (and similar) as an error in the response body, with a Retry-After header.
+  # result is either the decoded response, or the response itself (in which case the header says how long to wait).
+  body, retry_after = result, None
+  if hasattr(result, 'headers') and hasattr(result, 'json'):
+    retry_after = parse_retry_after(result.headers.get('Retry-After'))
+    if result.headers.get('Content-Type', '').startswith('application/json'):
+      body = result.json()
+  if isinstance(body, dict) and (error := body.get('error')) and error.get('code') in RETRY_CODES:
+    # The error's 'lag' is how far behind the replicas are, not how long to wait, so without the header use the default backoff.
+    raise Retry(error.get('info', error['code']), retry_after)
+  return result
+
+def get_retry_after(e):
+  # Returns how long to wait before retrying, 0 to retry after the default backoff, or None if the error is not retryable.
+  if isinstance(e, Retry):
+    return e.retry_after or 0
+  response = getattr(e, 'response', None)
+  if response is not None and getattr(response, 'status_code', None) in [429, 502, 503, 504]:
+    return parse_retry_after(response.headers.get('Retry-After')) or 0
+  import requests # Only needed once something has failed, and by then the wiki client has already loaded it
+  if isinstance(e, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)):
+    return 0
+  return None
+
+class Dispatcher:
+  def __init__(self, workers=4, rate=1, burst=5, retries=3, backoff=5):
+    self.workers = workers
+    self.bucket = TokenBucket(rate, burst)
+    self.retries = retries
+    self.backoff = backoff
+
+  def run_job(self, job):
+    for attempt in range(self.retries + 1):
+      self.bucket.acquire()
+      try:
+        with instrumentation.timer('dispatch.job'):
+          result = check_result(job.run())
+        if verbose:
+          print(f'{job.description}: {result}')
+        if job.on_success:
+          job.on_success()
+        instrumentation.count('dispatch.succeeded')
+        return result
+      except Exception as e:
+        retry_after = get_retry_after(e)
+        if retry_after is None or attempt == self.retries:
+          instrumentation.count('dispatch.failed')
+          raise
+        instrumentation.count('dispatch.retries')
+        delay = max(retry_after, self.backoff * 2 ** attempt)
+        print(f'{job.description} failed ({e}), retrying in {delay} seconds')
+        time.sleep(delay)
+
+  def run_jobs(self, jobs):
+    results = []
+    for job in jobs:
+      try:
+        results.append((job, self.run_job(job)))
+      except Exception as e:
+        import traceback
+        traceback.print_exc()
+        results.append((job, e))
+        break # Later jobs for the same page probably depend on this one
+    return results
+
+  def dispatch(self, jobs):
+    # Returns [(job, result or exception)] in the same order as the jobs. Jobs which were skipped are not included.
+    groups = collections.defaultdict(list)
+    for job in jobs:
+      groups[job.key].append(job)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      results = {}
+      for group_results in executor.map(self.run_jobs, groups.values()):
+        for job, result in group_results:
+          results[id(job)] = (job, result)
+    return [results[id(job)] for job in jobs if id(job) in results]
@@ -0,0 +1,117 @@
+import datetime
+import mmap
+import os
+import re
+import struct
+import sys
+
+verbose = False
+
+# A persistent store of every DOW open we've ever seen, so that geohashes for any past date can be computed offline.
+#
+# The file is a 16 byte header followed by one little-endian uint32 per calendar day since EPOCH, holding the open in cents
+# (0 means no data, e.g. for weekends and holidays). That makes lookups a single offset computation into a memory map,
+# and a century of data is only ~150 KB. Values are only ever added, never overwritten.
+MAGIC = b'DJIA'
+VERSION = 1
+HEADER = struct.Struct('<4sII4x') # magic, version, epoch (as a proleptic ordinal)
+RECORD = struct.Struct('<I')
+EPOCH = datetime.date(1928, 10, 1) # When the DJIA expanded to 30 stocks
+
+# We need to reproduce the exact string which was hashed, so only accept opens which round-trip through cents.
+DOW_FORMAT = re.compile(r'^\d+\.\d\d$')
+
+class DowHistory:
+  def __init__(self, path):
+    self.path = path
+    if not os.path.exists(path):
+      with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, EPOCH.toordinal()))
+
+    self.file = open(path, 'r+b')
+    magic, version, epoch = HEADER.unpack(self.file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+      raise ValueError(f'{path} is not a DOW history file (version {VERSION})')
+    self.epoch = epoch
+    self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def close(self):
+    self.mmap.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def get_offset(self, date):
+    return HEADER.size + (datetime.date.fromisoformat(date).toordinal() - self.epoch) * RECORD.size
+
+  # Same interface as the dow_opens dictionary, keyed by 'YYYY-MM-DD'
+  def get(self, date, default=None):
+    offset = self.get_offset(date)
+    if offset < HEADER.size or offset + RECORD.size > len(self.mmap):
+      return default
+    cents = RECORD.unpack_from(self.mmap, offset)[0]
+    if cents == 0:
+      return default
+    return f'{cents // 100}.{cents % 100:02}'
+
+  def __contains__(self, date):
+    return self.get(date) is not None
+
+  def latest(self):
+    # The most recent date with a known open, or None if the file is empty
+    for offset in range(len(self.mmap) - RECORD.size, HEADER.size - 1, -RECORD.size):
+      if RECORD.unpack_from(self.mmap, offset)[0]:
+        return datetime.date.fromordinal(self.epoch + (offset - HEADER.size) // RECORD.size).isoformat()
+    return None
+
+  def refresh(self):
+    # Picks up opens which another process has added since this file was opened. Returns True if there was anything new.
+    if os.fstat(self.file.fileno()).st_size == len(self.mmap):
+      return False # Existing records are never overwritten, so new data always grows the file
+    self.mmap.close()
+    self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    return True
+
+  def add(self, date, dow):
+    if not DOW_FORMAT.match(str(dow)):
+      print(f'Not storing DOW open for {date}, since "{dow}" is not in the expected format')
+      return False
+    offset = self.get_offset(date)
+    if offset < HEADER.size:
+      print(f'Not storing DOW open for {date}, since it is before {EPOCH}')
+      return False
+
+    existing = self.get(date)
+    if existing == dow:
+      return False
+    elif existing:
+      print(f'DOW open for {date} was already recorded as {existing}, ignoring new value {dow}')
+      return False
+
+    self.file.seek(offset)
+    self.file.write(RECORD.pack(int(dow.replace('.', ''))))
+    self.file.flush()
+    if offset + RECORD.size > len(self.mmap):
+      # Writing past the end of the file grows it (and fills the gap with zeros), so we need to remap.
+      self.mmap.close()
+      self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if verbose:
+      print(f'Stored DOW open for {date}: {dow}')
+    return True
+
+  def update(self, dow_opens):
+    added = 0
+    for date, dow in sorted(dow_opens.items()):
+      if self.add(date, dow):
+        added += 1
+    return added
+
+if __name__ == '__main__':
+  # Usage: python dow_history.py dow_history.bin [YYYY-MM-DD...]
+  with DowHistory(sys.argv[1]) as history:
+    for date in sys.argv[2:]:
+      print(date, history.get(date))
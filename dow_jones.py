@@ -1,67 +1,126 @@
 import collections
+import concurrent.futures
+import hashlib
 import json
-import re
-import requests
+import threading
+import time
 from datetime import datetime
 
+import html_tables
+import instrumentation
+import source_health
+
 verbose = False
 
-FIND_TABLE       = re.compile('<table[^>]*>(.*?)</table>')
-FIND_TABLE_ROWS  = re.compile('<tr[^>]*>(.*?)</tr>')
-FIND_TABLE_CELLS = re.compile('<td[^>]*>(.*?)</td>')
+MAX_ROWS = 10 # We only need the last few opens, older ones are already in the DOW history
+CHUNK_SIZE = 16 * 1024
+
+REQUEST_TIMEOUT = 30 # Seconds, per source. A source which is slower than this is not going to help us reach quorum.
+CONCURRENCY = 3 # Sources fetched at once. Enough for a quorum, and the rest are only fetched if one of those fails.
+
+# Anything with monotonic() and sleep(). Replay swaps in a clock which doesn't really sleep, so that a run which polled
+# for an hour replays in milliseconds.
+clock = time
+
+class NotModified(Exception):
+  pass
+
+# One session for the whole process, so that repeated polls reuse the same connections.
+# It's created on first use, so that importing this module (e.g. for the quorum logic) doesn't pull in requests.
+session = None
+session_lock = threading.Lock()
+
+def get_session():
+  global session
+  with session_lock:
+    if session is None:
+      import requests
+      session = requests.Session()
+      # Semi-accurately spoofing the Firefox UA
+      session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0 GithubJbzdarkidGeohashing/1.0'
+    return session
+
+# url: (etag, last-modified, content hash) from the last fetch which was parsed successfully
+validators = {}
+# Inside fetch_source, the validators from this thread's fetches are held here until the source has parsed the page,
+# so that a page which a broken scraper can't parse isn't skipped as 'not modified' on the next poll.
+pending = threading.local()
+
+def save_validators(url, etag, last_modified, content_hash):
+  if (pending_validators := getattr(pending, 'validators', None)) is not None:
+    pending_validators[url] = (etag, last_modified, content_hash)
+  else:
+    validators[url] = (etag, last_modified, content_hash)
 
 def get_url(url):
-  # Semi-accurately spoofing the Firefox UA
-  headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0 GithubJbzdarkidGeohashing/1.0'}
-  r = requests.get(url, headers=headers)
+  headers = {}
+  etag, last_modified, last_hash = validators.get(url, (None, None, None))
+  if etag:
+    headers['If-None-Match'] = etag
+  if last_modified:
+    headers['If-Modified-Since'] = last_modified
+
+  r = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+  if r.status_code == 304:
+    raise NotModified(url)
   if not r.ok:
     print(r.status_code, r.text)
   r.raise_for_status()
+
+  # Most of these sites don't support conditional requests, so also compare the contents directly.
+  content_hash = hashlib.sha1(r.content).hexdigest()
+  save_validators(url, r.headers.get('ETag'), r.headers.get('Last-Modified'), content_hash)
+  if content_hash == last_hash:
+    raise NotModified(url)
   return r.text
 
+def stream_url(url):
+  # Like get_url, but yields the page in chunks as it downloads, so that the caller can stop early.
+  # Since we don't read the whole page, this can only rely on the server for conditional requests.
+  headers = {}
+  etag, last_modified, _ = validators.get(url, (None, None, None))
+  if etag:
+    headers['If-None-Match'] = etag
+  if last_modified:
+    headers['If-Modified-Since'] = last_modified
+
+  with get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True) as r:
+    if r.status_code == 304:
+      raise NotModified(url)
+    if not r.ok:
+      print(r.status_code, r.text)
+    r.raise_for_status()
+    save_validators(url, r.headers.get('ETag'), r.headers.get('Last-Modified'), None)
+
+    if r.encoding is None:
+      r.encoding = 'utf-8'
+    yield from r.iter_content(CHUNK_SIZE, decode_unicode=True)
+
 # 2025-06-19 gives 404s a lot, might not be working
 def dow_from_yahoo():
-  text = get_url('https://finance.yahoo.com/quote/^DJI/history')
+  chunks = stream_url('https://finance.yahoo.com/quote/^DJI/history')
 
-  table = FIND_TABLE.findall(text)[0] # 1st table
-  for row in FIND_TABLE_ROWS.findall(table):
-    cells = FIND_TABLE_CELLS.findall(row)
-    if not cells:
-      continue
-
-    date = datetime.strptime(cells[0], '%b %d, %Y')
-    yield (date, cells[1].replace(',', ''))
+  for cells in html_tables.iter_table_rows(chunks, table_index=0, max_rows=MAX_ROWS): # 1st table
+    date = datetime.strptime(cells[0].text, '%b %d, %Y')
+    yield (date, cells[1].text.replace(',', ''))
 
 
 # Working as of 2025-06-19
 def dow_from_investing():
-  text = get_url('https://www.investing.com/indices/us-30-historical-data')
+  chunks = stream_url('https://www.investing.com/indices/us-30-historical-data')
 
-  table = FIND_TABLE.findall(text)[1] # 2nd table
-  for row in FIND_TABLE_ROWS.findall(table):
-    cells = FIND_TABLE_CELLS.findall(row)
-    if not cells:
-      continue
-
-    start_idx = cells[0].index('dateTime="')
-    end_idx = cells[0].index('">', start_idx)
-    date = datetime.strptime(cells[0][start_idx+10:end_idx], '%b %d, %Y')
-    yield (date, cells[2].replace(',', ''))
+  for cells in html_tables.iter_table_rows(chunks, table_index=1, max_rows=MAX_ROWS): # 2nd table
+    date = datetime.strptime(cells[0].attrs['datetime'], '%b %d, %Y') # From <time dateTime="...">
+    yield (date, cells[2].text.replace(',', ''))
 
 
 # Working as of 2025-06-19
 def dow_from_financialtimes():
-  text = get_url('https://markets.ft.com/data/indices/tearsheet/historical?s=DJI:DJI')
-
-  table = FIND_TABLE.findall(text)[0] # 1st table
-  for row in FIND_TABLE_ROWS.findall(table):
-    cells = FIND_TABLE_CELLS.findall(row)
-    if not cells:
-      continue
+  chunks = stream_url('https://markets.ft.com/data/indices/tearsheet/historical?s=DJI:DJI')
 
-    raw_date = re.search('<span[^>]*>(.*?)</span>', cells[0])
-    date = datetime.strptime(raw_date[1], '%A, %B %d, %Y')
-    yield (date, cells[1].replace(',', ''))
+  for cells in html_tables.iter_table_rows(chunks, table_index=0, max_rows=MAX_ROWS): # 1st table
+    date = datetime.strptime(cells[0].parts[0], '%A, %B %d, %Y') # The first <span> has the long-form date
+    yield (date, cells[1].text.replace(',', ''))
 
 
 # Not working 2025-06-19 (anti-bot technology)
@@ -93,52 +152,194 @@ def dow_from_businessinsider():
 def dow_from_marketwatch():
   text = get_url('https://www.marketwatch.com/investing/index/djia')
 
-  start_idx = text.index('<meta name="quoteTime" content="')
+  start_idx = text.index('<meta name="quoteTime" content="') + 32
   end_idx = text.index('"', start_idx)
-  date = datetime.strptime(text[start_index+32:end_idx-9], '%b %d, %Y')
+  date = datetime.strptime(' '.join(text[start_idx:end_idx].split(' ')[:3]), '%b %d, %Y') # e.g. 'Jun 18, 2025 9:30 a.m.'
 
-  start_idx = text.index('day-open="')
+  start_idx = text.index('day-open="') + 10
   end_idx = text.index('"', start_idx)
-  open = text[start_idx+10:end_idx]
+  open = text[start_idx:end_idx].replace(',', '')
 
   yield (date, open)
 
 
-dow_sources = [dow_from_investing, dow_from_financialtimes, dow_from_businessinsider]
-def get_dow_jones_opens():
+# Sources which break are put on a cooldown automatically (see source_health), but ones which are known not to work
+# (seekingalpha, marketwatch) are left out, since they would just cost requests until their cooldown kicks in.
+# The order here only matters until we have some stats, after which the most reliable sources are fetched first.
+dow_sources = [dow_from_investing, dow_from_financialtimes, dow_from_businessinsider, dow_from_yahoo]
+
+# Replaced with a persisted SourceHealth by main
+health = source_health.SourceHealth()
+
+# dow_source: rows from the last time it was parsed, for when the website hasn't changed since.
+last_rows = {}
+
+def fetch_source(dow_source):
+  # Sources are generators, so make sure the actual fetching happens on the worker thread.
+  name = dow_source.__name__
+  start = time.perf_counter()
+  pending.validators = {}
+  try:
+    rows = [(date.strftime('%Y-%m-%d'), dow) for date, dow in dow_source()]
+    validators.update(pending.validators)
+  except NotModified:
+    instrumentation.count(f'dow_jones.not_modified.{name}')
+    health.record_success(name, time.perf_counter() - start)
+    if verbose:
+      print(f'{name} has not changed since the last fetch')
+    return last_rows.get(dow_source, [])
+  except Exception:
+    instrumentation.count(f'dow_jones.failures.{name}')
+    health.record_failure(name, time.perf_counter() - start)
+    raise
+  finally:
+    pending.validators = None
+    instrumentation.observe(f'dow_jones.fetch.{name}', time.perf_counter() - start)
+  health.record_success(name, time.perf_counter() - start)
+  last_rows[dow_source] = rows
+  return rows
+
+def record_agreement(named_rows, dow_opens):
+  # Tracks whether each source agreed with the quorum, for every date that has one. named_rows is [(source name, rows)].
+  for name, rows in named_rows:
+    agreed = [dow == dow_opens[key] for key, dow in rows if key in dow_opens]
+    if agreed:
+      health.record_agreement(name, all(agreed))
+
+def rank_sources():
+  # Indices into dow_sources, best first, without the sources which are on cooldown
+  return health.rank([dow_source.__name__ for dow_source in dow_sources])
+
+def fetch_sources(sources, timeout=None, max_workers=None):
+  # Yields (index into sources, rows, exception) in the order that the sources finish.
+  # At most max_workers sources are fetched at once, in the order given, so put the best sources first.
+  # Closing the generator early (i.e. once the caller has a quorum) drops any sources which haven't finished (or started).
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers or len(sources), 1))
+  futures = {executor.submit(fetch_source, dow_source): i for i, dow_source in enumerate(sources)}
+  try:
+    for future in concurrent.futures.as_completed(futures, timeout=timeout):
+      try:
+        yield (futures[future], future.result(), None)
+      except Exception as e:
+        # Broken sources are common (and are handled by source_health), so only print the full traceback when debugging.
+        print(f'{sources[futures[future]].__name__} failed: {e!r}')
+        if verbose:
+          import traceback
+          traceback.print_exc()
+        yield (futures[future], None, e)
+  except concurrent.futures.TimeoutError:
+    print(f'Timed out after {timeout} seconds waiting for dow sources')
+  finally:
+    # Requests which are already in flight can't be interrupted, but their results will be ignored.
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def get_quorum(values):
+  if len(values) < 2: # We need at least 2 agreements (but ideally we have 3)
+    return None
+  value_dict = {}
+  for value in values:
+    value_dict[value] = value_dict.get(value, 0) + 1
+  for value, count in value_dict.items():
+    if count > len(values) / 2:
+      return value
+  return None
+
+def get_quorums(all_rows):
   temp_cache = collections.defaultdict(list)
-  for dow_source in dow_sources:
-    try:
-      for date, dow in dow_source():
-        temp_cache[date.strftime('%Y-%m-%d')].append(dow)
-    except:
-      import traceback
-      traceback.print_exc()
-      continue
+  for rows in all_rows:
+    for key, dow in rows:
+      temp_cache[key].append(dow)
 
   if verbose:
     print('Temp cache', temp_cache)
 
   dow_opens = {}
   for key, values in temp_cache.items():
-    if len(values) < 2: # We need at least 2 agreements (but ideally we have 3)
-      continue
-    value_dict = {}
-    for value in values:
-      value_dict[value] = value_dict.get(value, 0) + 1
-    for value, count in value_dict.items():
-      if count > len(values) / 2:
-        dow_opens[key] = value
-        break
-    else:
-      if verbose:
-        print(f'Not enough information to determine the DOW opening for {key}')
+    value = get_quorum(values)
+    if value is not None:
+      dow_opens[key] = value
+    elif verbose:
+      print(f'Not enough information to determine the DOW opening for {key}')
 
   if verbose:
     print('Dow opens', dow_opens)
 
   return dow_opens
 
+def get_dow_jones_opens(date=None, timeout=None):
+  # All sources are fetched concurrently. If a date is requested, we return as soon as there is a quorum for it,
+  # rather than waiting on the slowest website.
+  sources = [dow_sources[i] for i in rank_sources()]
+  named_rows = []
+  for i, rows, _ in fetch_sources(sources, timeout, CONCURRENCY):
+    if rows is None:
+      continue
+    named_rows.append((sources[i].__name__, rows))
+    if date and get_quorum([dow for _, rows in named_rows for key, dow in rows if key == date]) is not None:
+      if verbose:
+        print(f'Found a quorum for {date}, not waiting on the remaining sources')
+      break
+
+  dow_opens = get_quorums([rows for _, rows in named_rows])
+  record_agreement(named_rows, dow_opens)
+  return dow_opens
+
+class DowPoller:
+  # Repeatedly polls the dow sources until there is a quorum for the given date.
+  # Sources which already reported the date are not fetched again, and sources which fail are backed off exponentially.
+  def __init__(self, date, interval=60, max_interval=600):
+    self.date = date
+    self.interval = interval
+    self.max_interval = max_interval
+    # All of these are keyed by the source's index in dow_sources
+    self.rows = {} # Rows from the latest successful fetch
+    self.failures = collections.Counter() # Consecutive failures
+    self.next_poll = {} # clock.monotonic() when it should next be polled
+    self.ranked = [] # Sources to poll, best first (from the last poll)
+
+  def has_date(self, i):
+    return any(key == self.date for key, _ in self.rows.get(i, []))
+
+  def poll(self):
+    instrumentation.count('dow_jones.polls')
+    now = clock.monotonic()
+    self.ranked = rank_sources()
+    due = [i for i in self.ranked if not self.has_date(i) and self.next_poll.get(i, 0) <= now]
+    for j, rows, _ in fetch_sources([dow_sources[i] for i in due], max_workers=CONCURRENCY):
+      i = due[j]
+      if rows is None:
+        self.failures[i] += 1
+        backoff = min(self.interval * 2 ** self.failures[i], self.max_interval)
+        self.next_poll[i] = clock.monotonic() + backoff
+        continue
+
+      self.failures[i] = 0
+      self.rows[i] = rows
+      self.next_poll[i] = clock.monotonic() + self.interval
+      if get_quorum([dow for rows in self.rows.values() for key, dow in rows if key == self.date]) is not None:
+        break
+
+    return get_quorums(self.rows.values())
+
+  def wait(self, timeout):
+    deadline = clock.monotonic() + timeout
+    while True:
+      dow_opens = self.poll()
+      if self.date in dow_opens:
+        if verbose:
+          print(f'Dow jones open found for {self.date}: {dow_opens[self.date]}')
+        record_agreement([(dow_sources[i].__name__, rows) for i, rows in self.rows.items()], dow_opens)
+        return dow_opens
+
+      pending = [self.next_poll.get(i, 0) for i in self.ranked if not self.has_date(i)]
+      next_poll = min(pending, default=deadline)
+      if next_poll >= deadline:
+        record_agreement([(dow_sources[i].__name__, rows) for i, rows in self.rows.items()], dow_opens)
+        return dow_opens
+      if verbose:
+        print(f'Did not find dow jones open for {self.date}: {dow_opens}, sleeping')
+      clock.sleep(max(next_poll - clock.monotonic(), 0))
+
 
 if __name__ == '__main__':
   verbose = True
@@ -0,0 +1,131 @@
+import collections
+import html.parser
+
+# Incremental extraction of table rows from HTML, so that the scrapers can stop reading a page as soon as they have enough rows.
+# The pages we scrape are hundreds of KB, but we only need the first few rows of a single table.
+
+FEED_SIZE = 2048 # Characters fed to the parser at a time
+
+# text: all of the text in the cell. parts: each non-whitespace piece of text, in order (e.g. one per <span>).
+# attrs: every attribute on any element inside the cell (the first one wins if there are duplicates). Names are lowercase.
+Cell = collections.namedtuple('Cell', ['text', 'parts', 'attrs'])
+
+class TableExtractor(html.parser.HTMLParser):
+  def __init__(self, table_index, max_rows):
+    super().__init__(convert_charrefs=True)
+    self.table_index = table_index # Which table to extract rows from, counting from 0 in document order
+    self.max_rows = max_rows
+    self.tables_seen = 0
+    self.depth = 0 # How many tables deep we are inside the target table (to skip nested tables)
+    self.row = None
+    self.cell = None # ([text per element], attrs) of the cell being parsed
+    self.split = False # If the next piece of text is from a new element (text can also be split across chunks)
+    self.rows = collections.deque() # Completed rows, waiting to be consumed
+    self.rows_found = 0
+    self.done = False
+
+  def handle_starttag(self, tag, attrs):
+    if self.done:
+      return
+    self.split = True
+    if tag == 'table':
+      if self.depth > 0:
+        self.depth += 1
+      elif self.tables_seen == self.table_index:
+        self.depth = 1
+      self.tables_seen += 1
+    elif self.depth != 1:
+      return
+    elif tag == 'tr':
+      self.row = []
+    elif tag == 'td' and self.row is not None:
+      self.cell = ([], {})
+
+    if self.cell is not None and self.depth == 1:
+      for name, value in attrs:
+        self.cell[1].setdefault(name, value)
+
+  def handle_endtag(self, tag):
+    if self.done or self.depth == 0:
+      return
+    self.split = True
+    if tag == 'table':
+      self.depth -= 1
+      if self.depth == 0:
+        self.done = True
+    elif self.depth != 1:
+      return
+    elif tag == 'td' and self.cell is not None:
+      parts, attrs = self.cell
+      self.row.append(Cell(''.join(parts).strip(), [part.strip() for part in parts if part.strip()], attrs))
+      self.cell = None
+    elif tag == 'tr' and self.row is not None:
+      if self.row: # Skip header rows, which only have <th> cells
+        self.rows.append(self.row)
+        self.rows_found += 1
+        if self.rows_found >= self.max_rows:
+          self.done = True
+      self.row = None
+
+  def handle_data(self, data):
+    if self.cell is not None and self.depth == 1 and not self.done:
+      if self.split or not self.cell[0]:
+        self.cell[0].append(data)
+      else:
+        self.cell[0][-1] += data
+      self.split = False
+
+def find_table(text, tables_to_skip):
+  # Finds the table after skipping tables_to_skip of them, counting tables exactly the way the old regex did
+  # ('<table[^>]*>(.*?)</table>', without DOTALL), since each source's table_index was tuned against it:
+  # a table only counts if it closes on the same line its opening tag ends on, and it ends at the first '</table>',
+  # so a nested table doesn't count separately.
+  # Returns (offset of the table or -1, tables still to skip, offset to resume from once there's more text).
+  pos = 0
+  while True:
+    start = text.find('<table', pos)
+    if start == -1:
+      return (-1, tables_to_skip, max(len(text) - 5, pos)) # In case '<table' is split across chunks
+    tag_end = text.find('>', start)
+    table_end = text.find('</table>', tag_end) if tag_end != -1 else -1
+    line_end = text.find('\n', tag_end) if tag_end != -1 else -1
+    if table_end != -1 and (line_end == -1 or table_end < line_end):
+      if tables_to_skip == 0:
+        return (start, 0, start)
+      tables_to_skip -= 1
+      pos = table_end + len('</table>')
+    elif line_end != -1:
+      pos = start + 1 # The old regex couldn't match this table, so it doesn't count
+    else:
+      return (-1, tables_to_skip, start) # Can't tell until we have more of the page
+
+def iter_table_rows(chunks, table_index=0, max_rows=10):
+  # Yields each row (as a list of Cells) of the table_index-th table, from an iterable of text chunks.
+  # Stops reading chunks as soon as max_rows rows have been found, or the table ends.
+  #
+  # HTMLParser is quite slow, so we skip over everything before the target table with plain string searches (see find_table).
+  # (This does mean that a '<table' inside a script or comment would be counted, but so did the old regexes.)
+  parser = TableExtractor(0, max_rows)
+  tables_to_skip = table_index
+  pending = '' # Text we're still scanning for the start of the target table
+  try:
+    for chunk in chunks:
+      if pending is not None:
+        pending += chunk
+        start, tables_to_skip, resume = find_table(pending, tables_to_skip)
+        if start == -1:
+          pending = pending[resume:]
+          continue
+        chunk = pending[start:]
+        pending = None
+
+      # Feed in small pieces, so that we don't parse the rest of a large chunk once we're done.
+      for i in range(0, len(chunk), FEED_SIZE):
+        parser.feed(chunk[i:i+FEED_SIZE])
+        while parser.rows:
+          yield parser.rows.popleft()
+        if parser.done:
+          return
+  finally:
+    if hasattr(chunks, 'close'):
+      chunks.close() # Stop downloading the rest of the page
@@ -0,0 +1,73 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# Lightweight run metrics: nested phase timers, counters, and latency samples, written out as a JSON summary at the end of a run.
+# This is all module state (like the `verbose` flags), and is thread-safe, since dow_jones and dispatch do their work on thread pools.
+#
+#   with instrumentation.timer('load_configs'):  # Nested timers are reported as 'outer/inner'
+#     instrumentation.count('pages_parsed')
+#   instrumentation.observe('dow_jones.fetch.dow_from_investing', seconds)
+
+lock = threading.Lock()
+local = threading.local() # The stack of open timers, per thread
+timers = {} # path: [total seconds, calls]
+counters = collections.Counter()
+latencies = collections.defaultdict(list) # name: [seconds]
+started = time.perf_counter()
+
+def reset():
+  global started
+  with lock:
+    timers.clear()
+    counters.clear()
+    latencies.clear()
+    started = time.perf_counter()
+
+@contextlib.contextmanager
+def timer(name):
+  stack = local.__dict__.setdefault('stack', [])
+  stack.append(name)
+  path = '/'.join(stack)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    stack.pop()
+    with lock:
+      total = timers.setdefault(path, [0, 0])
+      total[0] += elapsed
+      total[1] += 1
+
+def count(name, n=1):
+  with lock:
+    counters[name] += n
+
+def observe(name, seconds):
+  with lock:
+    latencies[name].append(seconds)
+
+def summarize_latencies(samples):
+  samples = sorted(samples)
+  return {
+    'count': len(samples),
+    'mean': round(sum(samples) / len(samples), 4),
+    'p50': round(samples[len(samples) // 2], 4),
+    'max': round(samples[-1], 4),
+  }
+
+def summary():
+  with lock:
+    return {
+      'duration': round(time.perf_counter() - started, 4),
+      'timers': {path: {'seconds': round(seconds, 4), 'calls': calls} for path, (seconds, calls) in timers.items()},
+      'counters': dict(counters),
+      'latencies': {name: summarize_latencies(samples) for name, samples in latencies.items() if samples},
+    }
+
+def write_summary(path, **extra):
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump({**extra, **summary()}, f, indent=2)
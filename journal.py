@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+verbose = False
+
+# Append-only record of what a run has already done, so that a retried run can skip it instead of (e.g.) posting duplicate edits.
+# Each line is {"date": run date, "target": page or user, "step": "computed" | "edited" | "talkpage" | "emailed"}
+# "computed" entries also list the steps the target needs, so that a fully handled page can be skipped without recomputing it.
+class RunJournal:
+  def __init__(self, path, date):
+    self.path = path
+    self.date = date
+    self.lock = threading.Lock()
+    self.done = {} # (target, step): entry
+
+    entries = []
+    if os.path.exists(path):
+      with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+          try:
+            entries.append(json.loads(line))
+          except json.JSONDecodeError:
+            pass # The previous run probably died partway through writing this line
+
+    # Entries from previous days are no longer useful, so start a fresh file instead of growing forever.
+    entries = [entry for entry in entries if entry['date'] == date]
+    for entry in entries:
+      self.done[(entry['target'], entry['step'])] = entry
+    if entries and verbose:
+      print(f'Resuming run for {date}, {len(entries)} steps were already completed')
+
+    mode = 'a' if entries else 'w'
+    self.file = open(path, mode, encoding='utf-8')
+
+  def close(self):
+    self.file.close()
+
+  def is_done(self, target, step):
+    return (target, step) in self.done
+
+  def is_complete(self, target):
+    # True if this target was computed, and every step it needed has been completed since
+    entry = self.done.get((target, 'computed'))
+    return entry is not None and all(self.is_done(*need) for need in entry['needs'])
+
+  def record(self, target, step, **kwargs):
+    entry = {'date': self.date, 'target': target, 'step': step, **kwargs}
+    with self.lock:
+      self.done[(target, step)] = entry
+      self.file.write(json.dumps(entry) + '\n')
+      self.file.flush() # Make sure this survives the process being killed
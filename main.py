@@ -1,34 +1,65 @@
+import argparse
 import collections
+import collections.abc
 import datetime
+import functools
 import hashlib
+import json
 import os
-import time
-import zoneinfo
+import re
 from importlib import import_module
-Wiki = import_module('TFWiki-scripts.wikitools.wiki').Wiki
-Page = import_module('TFWiki-scripts.wikitools.page').Page
 
+import dispatch
+import dow_history
 import dow_jones
+import instrumentation
+import journal
+import nyse_calendar
+import page_cache
+import pipeline
+import source_health
+import spatial
 
 verbose = False
 
-def get_geohash(dow_opens, end_day, w30 = True):
+# The wiki client (and requests, which it uses) takes longer to import than the whole run does on a day when the market
+# is closed, so it's only loaded once we know there's work to do. Tests replace Page with a mock before calling main().
+Page = None
+
+def load_page():
+  global Page
+  if Page is None:
+    Page = import_module('TFWiki-scripts.wikitools.page').Page
+
+DOW_HISTORY_PATH = os.environ.get('DOW_HISTORY_PATH', 'dow_history.bin')
+PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH', 'page_cache.json')
+RUN_JOURNAL_PATH = os.environ.get('RUN_JOURNAL_PATH', 'run_journal.jsonl')
+RUN_METRICS_PATH = os.environ.get('RUN_METRICS_PATH', 'run_metrics.json')
+SOURCE_HEALTH_PATH = os.environ.get('SOURCE_HEALTH_PATH', 'source_health.json')
+HASH_COVERAGE_PATH = os.environ.get('HASH_COVERAGE_PATH', 'hash_coverage.json')
+PARSE_PROCESS_THRESHOLD = 2000 # Pages. For fewer than this, starting a process pool takes longer than the parsing.
+CONFIG_VERSION = 6 # Bump this whenever the output of config_to_json changes, to invalidate the page cache
+COVERAGE_RUNS = 5 # Runs to remember in the hash coverage file
+
+# The 30W rule states that coordinates east of Long -30 should be computed using the previous day's DOW opening.
+W30_RULE_START = datetime.datetime(2008, 5, 27, tzinfo=datetime.timezone.utc)
+
+def get_dow_open(dow_opens, end_day, w30 = True):
   last_dow_open = None
   date_range = [end_day - datetime.timedelta(days=i) for i in range(10)][::-1]
   for day in date_range:
-    # The 30W rule states that coordinates east of Long -30 should be computed using the previous day's DOW opening.
-    if not w30 and day >= datetime.datetime(2008, 5, 27, tzinfo=datetime.timezone.utc):
+    if not w30 and day >= W30_RULE_START:
       day -= datetime.timedelta(days = 1)
 
     date = day.strftime('%Y-%m-%d')
     if dow_open := dow_opens.get(date):
       last_dow_open = dow_open
 
-  if not last_dow_open:
-    print('DOW open could not be found, cannot compute geohash')
-    exit(1)
+  return last_dow_open
+
+def hash_geohash(end_day, dow_open):
   # Compute using the original unmodified day
-  hash_string = end_day.strftime('%Y-%m-%d') + '-' + last_dow_open
+  hash_string = end_day.strftime('%Y-%m-%d') + '-' + dow_open
   hash = hashlib.md5(hash_string.encode('utf-8')).hexdigest()
 
   latitude  = str(float.fromhex(f'0.{hash[:16]}'))[2:] # Convert hex to float then removing leading '0.'
@@ -39,24 +70,237 @@ def get_geohash(dow_opens, end_day, w30 = True):
 
   return (latitude, longitude, centicule)
 
+def get_geohash(dow_opens, end_day, w30 = True):
+  last_dow_open = get_dow_open(dow_opens, end_day, w30)
+  if not last_dow_open:
+    print('DOW open could not be found, cannot compute geohash')
+    exit(1)
+  return hash_geohash(end_day, last_dow_open)
+
+Geohash = collections.namedtuple('Geohash', ['latitude', 'longitude', 'centicule', 'dow_open'])
+Globalhash = collections.namedtuple('Globalhash', ['latitude', 'longitude', 'graticule', 'centicule'])
+
+def get_globalhash(geohash):
+  # The globalhash always uses the 30W rule, so it comes from the same hash as the E30 geohash, just scaled to cover the whole world.
+  latitude  = float(f'0.{geohash.latitude}') * 180 - 90
+  longitude = float(f'0.{geohash.longitude}') * 360 - 180
+  return Globalhash(latitude, longitude, *spatial.locate(latitude, longitude))
+
+class GeohashTable:
+  # The geohash only depends on (day, w30), so there are just two distinct answers per day no matter how many
+  # pages and graticules we process. Compute them all once up front, and then lookups are just a dict access.
+  # days: compute both rules for each of these days. targets: (day, w30) pairs, for when only one rule is known (see get_targets).
+  def __init__(self, dow_opens, days=(), targets=()):
+    self.hashes = {}
+    self.globalhashes = {}
+    for day, w30 in [(day, w30) for day in days for w30 in [True, False]] + list(targets):
+      dow_open = get_dow_open(dow_opens, day, w30)
+      if not dow_open:
+        print(f'DOW open could not be found for {day}, cannot compute geohash')
+        exit(1)
+      self.hashes[(day.toordinal(), w30)] = Geohash(*hash_geohash(day, dow_open), dow_open)
+      if not w30: # The globalhash always uses the 30W rule, so it's fixed whenever the E30 hash is.
+        self.globalhashes[day.toordinal()] = get_globalhash(self.hashes[(day.toordinal(), False)])
+
+  def has(self, day, w30 = True):
+    return (day.toordinal(), w30) in self.hashes
+
+  def get(self, day, w30 = True):
+    return self.hashes[(day.toordinal(), w30)]
+
+  def get_global(self, day):
+    return self.globalhashes[day.toordinal()]
+
+def get_targets(today, lookahead = False):
+  # Returns the (day, w30) geohashes which this run should report.
+  # Every day up until the next trading day will use today's DOW open, so they can all be computed now.
+  # For example, Fridays update the entire weekend, and the day before a holiday also updates the holiday.
+  next_trading_day = nyse_calendar.next_trading_day(today.date())
+  days = [today + datetime.timedelta(days=i) for i in range((next_trading_day - today.date()).days)]
+  targets = [(day, w30) for day in days for w30 in [True, False]]
+
+  # E30 hashes use the previous day's open, so the E30 hash for the next trading day is also fixed by today's open.
+  # Reporting it now means it goes out a day earlier, and a run on the next trading day only has to report the W30 hash.
+  if lookahead:
+    next_day = today + datetime.timedelta(days=len(days))
+    if next_day >= W30_RULE_START:
+      targets.append((next_day, False))
+  return targets
+
+def load_coverage(path, date):
+  # Returns the set of (YYYY-MM-DD, w30) geohashes which were reported by earlier runs. Entries from a previous attempt
+  # at today's run don't count, since the run journal already handles retries (and they may not have finished).
+  if not os.path.exists(path):
+    return set()
+  with open(path, 'r', encoding='utf-8') as f:
+    coverage = json.load(f)
+  return {tuple(key) for run_date, keys in coverage.items() if run_date != date for key in keys}
+
+def save_coverage(path, date, targets):
+  coverage = {}
+  if os.path.exists(path):
+    with open(path, 'r', encoding='utf-8') as f:
+      coverage = json.load(f)
+  coverage[date] = [(day.strftime('%Y-%m-%d'), w30) for day, w30 in targets]
+  # Only the last few runs can overlap with the next one (a run covers at most a long weekend, plus a day of lookahead).
+  coverage = {run_date: coverage[run_date] for run_date in sorted(coverage)[-COVERAGE_RUNS:]}
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(coverage, f, indent=2)
+
 DAY_OF_WEEK = 'monday, tuesday, wednesday, thursday, friday, saturday, sunday'.split(', ')
+NOTIFICATION_METHODS = ['config_page', 'email', 'talkpage']
+
+def iter_bits(mask):
+  while mask:
+    low_bit = mask & -mask
+    yield low_bit.bit_length() - 1
+    mask ^= low_bit
+
+class GraticuleSubscription:
+  # For each (day of week, notification method), a 100-bit mask of the subscribed centicules (bit 37 = centicule '37').
+  # For each day of week, the index of the first config line which subscribed to any centicules on that day (or None),
+  # since graticules are listed in that order for each day.
+  __slots__ = ['masks', 'first_line']
+
+  def __init__(self, masks=None, first_line=None):
+    self.masks = masks or [0] * (len(DAY_OF_WEEK) * len(NOTIFICATION_METHODS))
+    self.first_line = first_line or [None] * len(DAY_OF_WEEK)
+
+  def get_centicules(self, day_idx):
+    mask = 0
+    for method_idx in range(len(NOTIFICATION_METHODS)):
+      mask |= self.masks[day_idx * len(NOTIFICATION_METHODS) + method_idx]
+    return mask
+
+  def get_methods(self, day_idx, cent):
+    methods = {}
+    for method_idx, method in enumerate(NOTIFICATION_METHODS):
+      if self.masks[day_idx * len(NOTIFICATION_METHODS) + method_idx] >> cent & 1:
+        methods[method] = True
+    return methods
+
+class RadiusSubscription:
+  # Every geohash within `km` of (latitude, longitude), regardless of graticule.
+  # For each day of week, a mask of the notification methods (bit 0 = config_page).
+  __slots__ = ['latitude', 'longitude', 'km', 'masks']
+
+  def __init__(self, latitude, longitude, km, masks=None):
+    self.latitude = latitude
+    self.longitude = longitude
+    self.km = km
+    self.masks = masks or [0] * len(DAY_OF_WEEK)
+
+  def get_methods(self, day_idx):
+    return {method: True for method_idx, method in enumerate(NOTIFICATION_METHODS) if self.masks[day_idx] >> method_idx & 1}
+
+class Config(collections.abc.Mapping):
+  # Parsed config page, as a map of (lat, long) names:GraticuleSubscription, plus a map of (latitude, longitude, km):RadiusSubscription.
+  # Lines marked 'globalhash' are parsed into a separate Config (or None if there aren't any), and apply to the globalhash instead.
+  # For convenience (and the tests), this can also be read as a nested map, day-of-week:(lat, long):centicule:{notification_methods}
+  __slots__ = ['graticules', 'radius', 'globalhash']
+
+  def __init__(self):
+    self.graticules = {}
+    self.radius = {}
+    self.globalhash = None
+
+  def __getitem__(self, day_name):
+    return ConfigDay(self, DAY_OF_WEEK.index(day_name))
+
+  def __contains__(self, day_name):
+    return day_name in DAY_OF_WEEK and len(self[day_name]) > 0
+
+  def __iter__(self):
+    return (day_name for day_name in DAY_OF_WEEK if day_name in self)
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def get_graticules(self, day_idx):
+    # [(graticule, GraticuleSubscription)] for every graticule with centicules on this day, in the order they were first listed
+    graticules = [(graticule, subscription) for graticule, subscription in self.graticules.items() if subscription.get_centicules(day_idx)]
+    return sorted(graticules, key=lambda item: item[1].first_line[day_idx])
+
+def graticule_key(graticule):
+  # Graticules can also be looked up as ints, e.g. (47, -122). An int can't be -0, so that graticule is only reachable as '-0'.
+  return tuple(str(part) if isinstance(part, int) else part for part in graticule)
+
+class ConfigDay(collections.abc.Mapping):
+  __slots__ = ['config', 'day_idx']
+
+  def __init__(self, config, day_idx):
+    self.config = config
+    self.day_idx = day_idx
+
+  def __getitem__(self, graticule):
+    subscription = self.config.graticules.get(graticule_key(graticule)) if isinstance(graticule, tuple) else None
+    if subscription is None:
+      raise KeyError(graticule)
+    if not subscription.get_centicules(self.day_idx):
+      raise KeyError(graticule)
+    return ConfigCenticules(subscription, self.day_idx)
+
+  def __iter__(self):
+    return (graticule for graticule, _ in self.config.get_graticules(self.day_idx))
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def __eq__(self, other):
+    if not isinstance(other, collections.abc.Mapping):
+      return NotImplemented
+    return dict(self.items()) == {graticule_key(graticule): value for graticule, value in other.items()}
+
+class ConfigCenticules(collections.abc.Mapping):
+  __slots__ = ['subscription', 'day_idx']
+
+  def __init__(self, subscription, day_idx):
+    self.subscription = subscription
+    self.day_idx = day_idx
+
+  def __getitem__(self, cent):
+    if len(cent) != 2 or not cent.isdigit() or not (methods := self.subscription.get_methods(self.day_idx, int(cent))):
+      raise KeyError(cent)
+    return methods
+
+  def __iter__(self):
+    return (f'{cent:02}' for cent in iter_bits(self.subscription.get_centicules(self.day_idx)))
+
+  def __len__(self):
+    return self.subscription.get_centicules(self.day_idx).bit_count()
+
+def graticule_name(value):
+  # Graticules are named the way the wiki does (see spatial), so '-0' has to stay '-0' rather than becoming the '0' graticule.
+  value = value.strip()
+  return '-0' if value.startswith('-') and int(value) == 0 else str(int(value))
+
+# e.g. 'radius=25km@45.52/-122.68', for every geohash within 25 km of that point
+RADIUS_SETTING = re.compile(r'^radius=(\d+(?:\.\d+)?)km@(-?\d+(?:\.\d+)?)/(-?\d+(?:\.\d+)?)$')
+
 def parse_config(contents):
-  # Nested map, day-of-week:(lat, long):centicule:{notification_methods}
-  config = collections.defaultdict(
-    lambda: collections.defaultdict(
-      lambda: collections.defaultdict(dict)))
+  config = Config()
 
   lines = contents.split('\n')
-  for line in lines:
+  for line_idx, line in enumerate(lines):
     if line.count('|') < 5:
       continue
     parts = line.split('|')
-    lat = int(parts[1].strip())
-    long = int(parts[3].strip())
-    cents = parts[5].strip()
+    lat = graticule_name(parts[1])
+    long = graticule_name(parts[3])
+
+    cents = 0
+    for cent in parts[5].strip().replace(',', ' ').split(' '): # Separators may be ',' or ' '
+      if not cent: # Skip padding
+        continue
+      elif len(cent) == 2 and cent.isdigit():
+        cents |= 1 << int(cent)
+      else:
+        print(f'Unknown centicule: "{cent}"')
 
     target_days = []
     notification_methods = ['config_page']
+    radii = []
+    is_global = False
     if len(parts) >= 9:
       settings = parts[9].lower().replace(',', ' ').split(' ') # Separators may be ',' or ' '
       for setting in settings:
@@ -66,129 +310,396 @@ def parse_config(contents):
           target_days.append(setting)
         elif setting in ['email', 'talkpage']:
           notification_methods.append(setting)
+        elif setting == 'globalhash':
+          is_global = True
+        elif match := RADIUS_SETTING.match(setting):
+          km, latitude, longitude = map(float, match.groups())
+          if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            radii.append((latitude, longitude, km))
+          else:
+            print(f'Invalid radius location: "{setting}"')
         else:
           print(f'Unknown setting: "{setting}"')
     if len(target_days) == 0:
       target_days = DAY_OF_WEEK # If not specified, all the days of the week
 
+    target = config
+    if is_global:
+      if config.globalhash is None:
+        config.globalhash = Config()
+      target = config.globalhash
+      if not cents and not radii:
+        cents = (1 << 100) - 1 # For the globalhash, just listing a graticule means the entire graticule
+
+    subscription = target.graticules.setdefault((lat, long), GraticuleSubscription())
     for day in target_days:
-      for cent in cents.replace(',', ' ').split(' '): # Separators may be ',' or ' '
-        if cent: # Only handle non-empty to skip padding
-          for method in notification_methods:
-            config[day][(lat, long)][cent][method] = True
+      day_idx = DAY_OF_WEEK.index(day)
+      if cents and subscription.first_line[day_idx] is None:
+        subscription.first_line[day_idx] = line_idx
+      for method in notification_methods:
+        subscription.masks[day_idx * len(NOTIFICATION_METHODS) + NOTIFICATION_METHODS.index(method)] |= cents
+
+    for key in radii:
+      subscription = target.radius.setdefault(key, RadiusSubscription(*key))
+      for day in target_days:
+        for method in notification_methods:
+          subscription.masks[DAY_OF_WEEK.index(day)] |= 1 << NOTIFICATION_METHODS.index(method)
 
   return config
 
-def main(w, today):
-  event = os.environ.get('GITHUB_EVENT_NAME', 'local_run')
+# JSON can't have tuple keys, so graticules are stored as a list of [lat, long, masks, first_line], and radii as [latitude, longitude, km, masks]
+def config_to_json(config):
+  return {
+    'graticules': [[lat, long, subscription.masks, subscription.first_line] for (lat, long), subscription in config.graticules.items()],
+    'radius': [[*key, subscription.masks] for key, subscription in config.radius.items()],
+    'globalhash': config_to_json(config.globalhash) if config.globalhash is not None else None,
+  }
+
+def config_from_json(value):
+  config = Config()
+  for lat, long, masks, first_line in value['graticules']:
+    config.graticules[(lat, long)] = GraticuleSubscription(masks, first_line)
+  for latitude, longitude, km, masks in value['radius']:
+    config.radius[(latitude, longitude, km)] = RadiusSubscription(latitude, longitude, km, masks)
+  if value['globalhash']:
+    config.globalhash = config_from_json(value['globalhash'])
+  return config
+
+def find_page_hits(config, geohashes, days):
+  # Returns {(day, *graticule) or (day, 'global'): (day, order, graticule, geohash, notification methods, distance)} for one page.
+  # Centicule hits are ordered before radius hits, and distance is None for centicule hits.
+  # Globalhash hits come last, with a graticule of None and a Globalhash instead of a Geohash.
+  # Each graticule's mask is checked against the day's centicule directly, and distances are only computed for the graticules
+  # near each radius subscription, so there's no need for an index of every page.
+  hits = {}
+  for day in days:
+    day_idx = day.weekday()
+    for order, (graticule, subscription) in enumerate(config.get_graticules(day_idx)):
+      w30 = int(graticule[1]) < -30
+      if not geohashes.has(day, w30):
+        continue
+      geohash = geohashes.get(day, w30)
+      if notifications := subscription.get_methods(day_idx, int(geohash.centicule)):
+        hits[(day, *graticule)] = (day, (0, order), graticule, geohash, notifications, None)
+
+    for order, subscription in enumerate(config.radius.values()):
+      if not subscription.masks[day_idx]:
+        continue
+      for graticule in spatial.graticules_near(subscription.latitude, subscription.longitude, subscription.km):
+        w30 = int(graticule[1]) < -30
+        if not geohashes.has(day, w30):
+          continue
+        geohash = geohashes.get(day, w30)
+        point = spatial.graticule_point(graticule, geohash.latitude, geohash.longitude)
+        distance = spatial.distance_km(subscription.latitude, subscription.longitude, *point)
+        if distance > subscription.km:
+          continue
+        if existing := hits.get((day, *graticule)):
+          hits[(day, *graticule)] = (*existing[:4], {**existing[4], **subscription.get_methods(day_idx)}, existing[5])
+        else:
+          hits[(day, *graticule)] = (day, (1, order), graticule, geohash, subscription.get_methods(day_idx), distance)
 
-  if event != 'local_run':
-    if not w.login(os.environ['WIKI_USERNAME'], os.environ['WIKI_PASSWORD']):
-      exit(1)
+    if config.globalhash is None or not geohashes.has(day, False):
+      continue
+    globalhash = geohashes.get_global(day)
+    notifications, order, distance = {}, None, None
+    global_config = config.globalhash
+    graticules = list(global_config.graticules)
+    if globalhash.graticule in global_config.graticules:
+      if methods := global_config.graticules[globalhash.graticule].get_methods(day_idx, int(globalhash.centicule)):
+        notifications, order = methods, (0, graticules.index(globalhash.graticule))
+    for radius_order, subscription in enumerate(global_config.radius.values()):
+      if not subscription.masks[day_idx]:
+        continue
+      radius_distance = spatial.distance_km(subscription.latitude, subscription.longitude, globalhash.latitude, globalhash.longitude)
+      if radius_distance <= subscription.km:
+        if order is None:
+          order, distance = (1, radius_order), radius_distance
+        notifications = {**notifications, **subscription.get_methods(day_idx)}
+    if order is not None:
+      hits[(day, 'global')] = (day, (2, order), None, globalhash, notifications, distance)
+  return hits
+
+def render_hits(w, page, page_hits):
+  # Returns the lines to add to the config page, the user's talk page, and the user's email, for one page's hits.
+  config_contents = []
+  talk_contents = []
+  email_message = []
 
-  if event == 'workflow_dispatch':
-    # For manual runs (aka testing), don't spam other users' pages.
-    pages = [Page(w, 'User:Darkid/Potential expeditions')]
-  else:
-    pages = w.get_all_category_pages('Category:Tracked by DarkBOT', namespaces=['User'])
+  # Keep the same order as the config page: by day, then by graticule.
+  for day, _, graticule, geohash, notifications, distance in sorted(page_hits.values(), key=lambda hit: hit[:2]):
+    date = day.strftime('%Y-%m-%d')
+    if graticule is None:
+      kind = 'globalhash'
+      (latitude, longitude, (lat, long), centicule) = geohash
+      expedition = Page(w, f'{date} global')
+      map_link = f'https://maps.google.com/?q={latitude},{longitude}'
+    else:
+      kind = 'geohashing site'
+      (lat, long), (latitude, longitude, centicule, _) = graticule, geohash
+      expedition = Page(w, f'{date} {lat} {long}')
+      map_link = f'https://maps.google.com/?q={lat}.{latitude},{long}.{longitude}'
 
-  if today.weekday() in [0, 1, 2, 3]:
-    days = [today]
+    if distance is not None:
+      label = location = f'{distance:.1f} km from home'
+    elif graticule is None:
+      label, location = f'Graticule {lat} {long}, centicule {centicule}', f'in graticule {lat} {long}, centicule {centicule}'
+    else:
+      label, location = f'Centicule {centicule}', f'in centicule {centicule}'
     if verbose:
-      print(f'{DAY_OF_WEEK[today.weekday()]} (index {today.weekday()}) is a weekday, running a single update')
-  elif today.weekday() == 4:
-    # Fridays update the entire weekend (since it's known by that point)
-    # In theory we could update monday if it's a DOW holiday -- but that's really complicated logic and I don't want to do it.
-    # I could also just parse the NYSE holiday hours webpage.
-    days = [today, today + datetime.timedelta(days=1), today + datetime.timedelta(days=2)]
+      print(f'Found {kind} on {date} {location} for {page.title}: {lat, long, centicule}')
+
+    if notifications.get('config_page'):
+      config_contents.append(f'\n=== [{expedition.get_edit_url()} {expedition.title}] ===')
+      config_contents.append(f'[{map_link} {label}]')
+
+    if notifications.get('talkpage'):
+      talk_contents.append(f'\n== New {kind} on {date} ==')
+      talk_contents.append(f'See [[{page}]]')
+
+    if notifications.get('email'):
+      email_message.append(f'<h2>New {kind} on {date}, {location}</h2>')
+      email_message.append(f'Map link: <a href="{map_link}">{map_link}</a>')
+      email_message.append(f'Config page: <a href="{page.get_page_url()}">{page.title}</a>')
+      email_message.append(f'Expedition page: <a href="{expedition.get_edit_url()}">{expedition.title}</a>')
+
+  return config_contents, talk_contents, email_message
+
+# The stages of the pipeline in main(). Each takes the output of the previous one.
+def parse_page(entry):
+  # entry is (title, revid, text or None, cached config or None) from PageCache.fetch, or None if the page doesn't exist.
+  # Returns the entry with the parsed config, and whether it was parsed just now (rather than coming from the cache).
+  # This may run on a process pool, so it has to be a top-level function.
+  if entry is None:
+    return None
+  title, revid, text, value = entry
+  if value is not None:
+    return (title, revid, text, value, False)
+  return (title, revid, text, config_to_json(parse_config(text)), True)
+
+def match_page(geohashes, days, entry):
+  if entry is None:
+    return (None, {})
+  return (entry, find_page_hits(config_from_json(entry[3]), geohashes, days))
+
+def render_page(w, pages_by_title, run_journal, item):
+  # Returns (entry, number of hits, rendered lines or None if there is nothing to do)
+  entry, page_hits = item
+  if not page_hits:
+    return (entry, 0, None)
+  page = pages_by_title[entry[0]]
+  if run_journal.is_complete(page.title):
     if verbose:
-      print('Today is a Friday, so running a triple update for the weekend.')
-  elif today.weekday() in [5, 6]:
+      print(f'Already handled {page.title} in a previous attempt')
+    return (entry, len(page_hits), None)
+  if verbose:
+    print(f'Handling {page.title}...')
+  return (entry, len(page_hits), render_hits(w, page, page_hits))
+
+def append_to_page(page, contents, **kwargs):
+  # Read-modify-write in one step, so that a retry will pick up any changes made in the meantime.
+  text = page.get_wiki_text()
+  text += contents
+  return page.edit(text, bot=True, maxlag=dispatch.MAXLAG, **kwargs)
+
+def main(w, today, lookahead = False):
+  if not nyse_calendar.is_trading_day(today.date()):
     if verbose:
-      print('Today is a weekend, so the geohashes were already computed Friday.')
+      print(f'{today.date()} is not a trading day, so the geohashes were already computed on the last trading day.')
     return
+  load_page()
+
+  # Report every geohash which is already fixed, except the ones which an earlier run has already reported
+  # (e.g. today's E30 hash, if yesterday's run was in lookahead mode).
+  covered = load_coverage(HASH_COVERAGE_PATH, today.strftime('%Y-%m-%d'))
+  targets = [(day, w30) for day, w30 in get_targets(today, lookahead) if (day.strftime('%Y-%m-%d'), w30) not in covered]
+  days = sorted({day for day, _ in targets})
+  if verbose:
+    print(f'Next trading day is {nyse_calendar.next_trading_day(today.date())}, so running an update for {len(targets)} geohash(es) over {len(days)} day(s)')
+
+  event = os.environ.get('GITHUB_EVENT_NAME', 'local_run')
+
+  with instrumentation.timer('login'):
+    if event != 'local_run':
+      if not w.login(os.environ['WIKI_USERNAME'], os.environ['WIKI_PASSWORD']):
+        exit(1)
+
+    if event == 'workflow_dispatch':
+      # For manual runs (aka testing), don't spam other users' pages.
+      pages = [Page(w, 'User:Darkid/Potential expeditions')]
+    else:
+      pages = w.get_all_category_pages('Category:Tracked by DarkBOT', namespaces=['User'])
 
   # The Dow Jones Industrial Average opens with the New York Stock Exchange at 9:30 AM, Eastern Time.
   # The reporting for the value is usually available within two hours, so if we can't find an opening value by then,
-  # assume it's a weekend or a holiday. See https://www.nyse.com/markets/hours-calendars for more precise holiday info.
-  date = today.strftime('%Y-%m-%d')
-  for _ in range(120):
-    dow_opens = dow_jones.get_dow_jones_opens() # This samples 3 websites, and only reports data if >= 2 of them agree.
-    if date in dow_opens:
+  # assume it's an unscheduled closure (scheduled holidays are handled by nyse_calendar).
+  with instrumentation.timer('dow_jones'):
+    date = today.strftime('%Y-%m-%d')
+    history = dow_history.DowHistory(DOW_HISTORY_PATH)
+    if date in history:
       if verbose:
-        print(f'Dow jones open found for {date}: {dow_opens[date]}')
-      break
-    if verbose:
-      print(f'Did not find dow jones open for {date}: {dow_opens}, sleeping')
-    time.sleep(60) # Sleep for 60 seconds
+        print(f'Dow jones open for {date} is already known: {history.get(date)}')
+    else:
+      # Sources are polled in order of how reliable they've been, and ones which keep failing are skipped for a while.
+      dow_jones.health = source_health.SourceHealth(SOURCE_HEALTH_PATH)
+      poller = dow_jones.DowPoller(date) # This samples 3 websites, and only reports data once >= 2 of them agree.
+      history.update(poller.wait(timeout=120 * 60))
+      dow_jones.health.save()
+
+  # There are only two centicules in play each day (W30 and E30), so compute them once up front.
+  with instrumentation.timer('hash'):
+    geohashes = GeohashTable(history, targets=targets)
+    history.close()
 
   # Now that the stock exchange has opened (and we have information about the dow jones), we can process geohashes.
-  for page in pages:
-    if verbose:
-      print(f'Handling {page.title}...')
-    config_contents = []
-    talk_contents = []
-    email_message = []
-
-    config = parse_config(page.get_wiki_text())
-    for day in days:
-      day_name = DAY_OF_WEEK[day.weekday()]
-      for (lat, long), data in config[day_name].items():
-        (latitude, longitude, centicule) = get_geohash(dow_opens, day, long < -30)
-        if centicule not in data:
-          print(f'For day {day}, centicule {centicule} is not within the configured centicules:', ', '.join(data.keys()))
-          continue
+  # Each page goes through a pipeline, so that (for example) the next batch of pages is downloading while this one is parsed:
+  #   fetch: download config pages in batches, skipping the contents of pages which haven't changed since the last run
+  #   parse: parse any pages which have changed. This is CPU-bound, so it moves to a process pool when there are lots of pages.
+  #   match: find the geohashes which hit each page's subscriptions
+  #   render: build the text for the config page, talk page and email
+  # Results come out in page order, so the edits are exactly the same as doing one page at a time.
+  cache = page_cache.PageCache(PAGE_CACHE_PATH, CONFIG_VERSION)
+  # If this is a retry of a run which died partway through, skip anything which was already done.
+  run_journal = journal.RunJournal(RUN_JOURNAL_PATH, today.strftime('%Y-%m-%d'))
+  pages_by_title = {page.title: page for page in pages}
+  stages = [
+    pipeline.Stage('fetch', lambda batch: cache.fetch(w, [page.title for page in batch]), workers=2, batch_size=page_cache.BATCH_SIZE),
+    pipeline.Stage('parse', parse_page, workers=os.cpu_count() or 1, processes=len(pages) >= PARSE_PROCESS_THRESHOLD),
+    pipeline.Stage('match', functools.partial(match_page, geohashes, days)),
+    pipeline.Stage('render', functools.partial(render_page, w, pages_by_title, run_journal)),
+  ]
+  instrumentation.count('pages_tracked', len(pages))
 
-        if verbose:
-          print(f'Found geohash on {day} within centicules for {page.title}: {lat, long, centicule}')
-
-        date = day.strftime('%Y-%m-%d')
-        expedition = Page(w, f'{date} {lat} {long}')
-        map_link = f'https://maps.google.com/?q={lat}.{latitude},{long}.{longitude}'
-
-        notifications = data[centicule]
-        if notifications.get('config_page'):
-          config_contents.append(f'\n=== [{expedition.get_edit_url()} {expedition.title}] ===')
-          config_contents.append(f'[{map_link} Centicule {centicule}]')
-
-        if notifications.get('talkpage'):
-          talk_contents.append(f'\n== New geohashing site on {date} ==')
-          talk_contents.append(f'See [[{page}]]')
-
-        if notifications.get('email'):
-          email_message.append(f'<h2>New geohashing site on {date}, in centicule {centicule}</h2>')
-          email_message.append(f'Map link: <a href="{map_link}">{map_link}</a>')
-          email_message.append(f'Config page: <a href="{page.get_page_url()}">{page.title}</a>')
-          email_message.append(f'Expedition page: <a href="{expedition.get_edit_url()}">{expedition.title}</a>')
-
-    # End 'for day in days'
-    if config_contents:
-      config = page.get_wiki_text()
-      config += '\n'.join(config_contents)
-      r = page.edit(config, bot=True, summary='Automatic update via https://github.com/jbzdarkid/geohashing')
-      if verbose:
-        print(f'Edited config page {page}: {r}')
-    if talk_contents:
-      talkpage_title = page.basename.split('/', 1)[0] # User:Darkid/Foo -> User:Darkid
-      talkpage = Page(w, talkpage_title.replace('User:', 'User talk:'))
-      talk = talkpage.get_wiki_text()
-      talk += '\n'.join(talk_contents)
-      r = talkpage.edit(talk, bot=True, summary='New geohash(es) in your centicule(s)')
-      if verbose:
-        print(f'Edited talkpage {talkpage}: {r}')
-    if email_message:
+  jobs = []
+  # A user may have several config pages, but they should only get one talk page edit and one email per run.
+  talk_contents = collections.defaultdict(list) # user: [lines]
+  email_message = collections.defaultdict(list) # user: [lines]
+  with instrumentation.timer('pipeline'):
+    for entry, hit_count, rendered in pipeline.run(pages, stages):
+      if entry is None: # The page doesn't exist
+        continue
+      title, revid, text, value, parsed = entry
+      if parsed:
+        cache.set(title, revid, value)
+        instrumentation.count('pages_parsed')
+      instrumentation.count('hits', hit_count)
+      if rendered is None:
+        continue
+
+      page = pages_by_title[title]
       user = page.basename.split('/', 1)[0] # User:Darkid/Foo -> User:Darkid
-      title = 'New geohash(es) in your centicule(s)'
-      email = '<br>'.join(email_message)
-      r = w.email_user(user, title, email)
-      if verbose:
-        print(f'Sent email to {user}: {r}')
+      config_contents, talk_lines, email_lines = rendered
+      talk_contents[user] += talk_lines
+      email_message[user] += email_lines
+
+      needs = []
+      if config_contents:
+        needs.append((page.title, 'edited'))
+      if talk_contents[user]:
+        needs.append((user, 'talkpage'))
+      if email_message[user]:
+        needs.append((user, 'emailed'))
+      run_journal.record(page.title, 'computed', needs=needs)
+
+      if config_contents and not run_journal.is_done(page.title, 'edited'):
+        # The edit may be sent a long time after the page was fetched, so re-read it then, rather than overwriting any changes since.
+        edit = functools.partial(append_to_page, page, '\n'.join(config_contents), summary='Automatic update via https://github.com/jbzdarkid/geohashing')
+        on_success = functools.partial(run_journal.record, page.title, 'edited')
+        jobs.append(dispatch.Job(page.title, f'Edited config page {page}', edit, on_success))
+  cache.save()
+
+  for user, lines in talk_contents.items():
+    if not lines or run_journal.is_done(user, 'talkpage'):
+      continue
+    talkpage = Page(w, user.replace('User:', 'User talk:'))
+    edit = functools.partial(append_to_page, talkpage, '\n'.join(lines), summary='New geohash(es) in your centicule(s)')
+    on_success = functools.partial(run_journal.record, user, 'talkpage')
+    jobs.append(dispatch.Job(talkpage.title, f'Edited talkpage {talkpage}', edit, on_success))
+  for user, lines in email_message.items():
+    if not lines or run_journal.is_done(user, 'emailed'):
+      continue
+    title = 'New geohash(es) in your centicule(s)'
+    email = '<br>'.join(lines)
+    on_success = functools.partial(run_journal.record, user, 'emailed')
+    jobs.append(dispatch.Job(f'email:{user}', f'Sent email to {user}', functools.partial(w.email_user, user, title, email, maxlag=dispatch.MAXLAG), on_success))
+
+  # Edits are slow (and rate limited), so they're sent in parallel once all the computation is done.
+  with instrumentation.timer('dispatch'):
+    results = dispatch.Dispatcher().dispatch(jobs)
+  failures = [job for job, result in results if isinstance(result, Exception)]
+  for job, result in results:
+    if not isinstance(result, Exception):
+      instrumentation.count('emails' if job.key.startswith('email:') else 'edits')
+  run_journal.close()
+  if failures or len(results) < len(jobs):
+    # Fail the run, so that it gets retried. The retry picks up from the journal, and only sends what's left.
+    print(f'{len(failures)} of {len(jobs)} notifications failed, and {len(jobs) - len(results)} were skipped')
+    exit(1)
+  save_coverage(HASH_COVERAGE_PATH, today.strftime('%Y-%m-%d'), targets)
+
+def install_replay(path):
+  # Reruns a recorded run offline (see replay), returning the Replayer. Its metadata has the date of the recorded run.
+  global DOW_HISTORY_PATH, PAGE_CACHE_PATH, RUN_JOURNAL_PATH, SOURCE_HEALTH_PATH, HASH_COVERAGE_PATH
+  import replay
+  import tempfile
+  recorder = replay.install('replay', path)
+  # Start from scratch, so that the run does the same work as the recorded one (and doesn't touch the real state files).
+  state = tempfile.mkdtemp()
+  DOW_HISTORY_PATH = os.path.join(state, 'dow_history.bin')
+  PAGE_CACHE_PATH = os.path.join(state, 'page_cache.json')
+  RUN_JOURNAL_PATH = os.path.join(state, 'run_journal.jsonl')
+  SOURCE_HEALTH_PATH = os.path.join(state, 'source_health.json')
+  HASH_COVERAGE_PATH = os.path.join(state, 'hash_coverage.json')
+  # The wiki isn't really being edited, so there's no need to wait on the rate limit,
+  # and the responses are already recorded, so there's no need to wait between polls either.
+  dispatch.Dispatcher = functools.partial(dispatch.Dispatcher, rate=1e9, burst=1e9)
+  dow_jones.clock = replay.ReplayClock()
+  return recorder
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--profile', metavar='PATH', help='Write a cProfile dump of the run to this file')
+  parser.add_argument('--lookahead', action='store_true', help='Also report hashes for later days which are already fixed (the E30 hash for the next trading day)')
+  parser.add_argument('--record', metavar='FIXTURE', help='Save every HTTP response to this file (.json.gz), for --replay')
+  parser.add_argument('--replay', metavar='FIXTURE', help='Rerun a recorded run offline, using the responses (and date) from --record')
+  args = parser.parse_args()
+
   verbose = True
-  w = Wiki('https://geohashing.site/api.php')
+  dispatch.verbose = True
 
+  import zoneinfo
   eastern_time = zoneinfo.ZoneInfo('America/New_York')
   today = datetime.datetime.now(tz=eastern_time)
 
-  main(w, today)
+  recorder = None
+  if args.record or args.replay:
+    import replay
+    replay.verbose = True
+  if args.record:
+    recorder = replay.install('record', args.record, today=today.isoformat())
+  elif args.replay:
+    recorder = install_replay(args.replay)
+    today = datetime.datetime.fromisoformat(recorder.metadata['today'])
+
+  # When the market is closed, main() returns straight away, so don't load the wiki client just to construct it.
+  w = None
+  if nyse_calendar.is_trading_day(today.date()):
+    w = import_module('TFWiki-scripts.wikitools.wiki').Wiki('https://geohashing.site/api.php')
+
+  if args.profile:
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+  try:
+    with instrumentation.timer('main'):
+      main(w, today, args.lookahead)
+  finally:
+    # This is written even if the run fails (or exits early), since that's when it's most useful.
+    if args.profile:
+      profiler.disable()
+      profiler.dump_stats(args.profile)
+    instrumentation.write_summary(RUN_METRICS_PATH, date=today.strftime('%Y-%m-%d'))
+    if verbose:
+      print(f'Wrote run metrics to {RUN_METRICS_PATH}')
+    if recorder:
+      recorder.save()
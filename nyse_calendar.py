@@ -0,0 +1,106 @@
+import datetime
+import functools
+
+# Rule-based NYSE holidays, so that we don't need to poll for two hours to discover that the market is closed.
+# See https://www.nyse.com/markets/hours-calendars
+
+# One-off closures which can't be predicted by rules (national days of mourning, weather, etc). These have to be added by hand.
+SPECIAL_CLOSURES = {
+  datetime.date(2001, 9, 11): 'September 11th',
+  datetime.date(2001, 9, 12): 'September 11th',
+  datetime.date(2001, 9, 13): 'September 11th',
+  datetime.date(2001, 9, 14): 'September 11th',
+  datetime.date(2004, 6, 11): 'National Day of Mourning for Ronald Reagan',
+  datetime.date(2007, 1, 2):  'National Day of Mourning for Gerald Ford',
+  datetime.date(2012, 10, 29): 'Hurricane Sandy',
+  datetime.date(2012, 10, 30): 'Hurricane Sandy',
+  datetime.date(2018, 12, 5): 'National Day of Mourning for George H. W. Bush',
+  datetime.date(2025, 1, 9):  'National Day of Mourning for Jimmy Carter',
+}
+
+EARLY_CLOSE = datetime.time(13, 0) # Early closes are at 1:00 PM Eastern, instead of 4:00 PM
+
+def easter(year):
+  # Anonymous Gregorian algorithm, see https://en.wikipedia.org/wiki/Date_of_Easter#Anonymous_Gregorian_algorithm
+  a = year % 19
+  b, c = divmod(year, 100)
+  d, e = divmod(b, 4)
+  f = (b + 8) // 25
+  g = (b - f + 1) // 3
+  h = (19 * a + b - d - g + 15) % 30
+  i, k = divmod(c, 4)
+  l = (32 + 2 * e + 2 * i - h - k) % 7
+  m = (a + 11 * h + 22 * l) // 451
+  month, day = divmod(h + l - 7 * m + 114, 31)
+  return datetime.date(year, month, day + 1)
+
+def nth_weekday(year, month, weekday, n):
+  # n-th (1-indexed) occurrence of a weekday (0 = monday) in a month, or the last one if n is -1
+  if n > 0:
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+  else:
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+def observed(day):
+  # Holidays on a saturday are observed the friday before, and holidays on a sunday are observed the monday after.
+  if day.weekday() == 5:
+    return day - datetime.timedelta(days=1)
+  elif day.weekday() == 6:
+    return day + datetime.timedelta(days=1)
+  return day
+
+@functools.lru_cache
+def holidays(year):
+  days = {}
+  # New Year's Day is not observed on the previous friday, since that would be in a different (fiscal) year.
+  new_years = datetime.date(year, 1, 1)
+  if new_years.weekday() != 5:
+    days[observed(new_years)] = "New Year's Day"
+  if year >= 1998:
+    days[nth_weekday(year, 1, 0, 3)] = 'Martin Luther King, Jr. Day'
+  days[nth_weekday(year, 2, 0, 3)] = "Washington's Birthday"
+  days[easter(year) - datetime.timedelta(days=2)] = 'Good Friday'
+  days[nth_weekday(year, 5, 0, -1)] = 'Memorial Day'
+  if year >= 2022:
+    days[observed(datetime.date(year, 6, 19))] = 'Juneteenth National Independence Day'
+  days[observed(datetime.date(year, 7, 4))] = 'Independence Day'
+  days[nth_weekday(year, 9, 0, 1)] = 'Labor Day'
+  days[nth_weekday(year, 11, 3, 4)] = 'Thanksgiving Day'
+  days[observed(datetime.date(year, 12, 25))] = 'Christmas Day'
+
+  for day, name in SPECIAL_CLOSURES.items():
+    if day.year == year:
+      days[day] = name
+  return days
+
+@functools.lru_cache
+def early_closes(year):
+  days = {}
+  # The day before Independence Day, unless that is a weekend or the observed holiday
+  july_3 = datetime.date(year, 7, 3)
+  if july_3.weekday() in [0, 1, 2, 3]:
+    days[july_3] = 'Independence Day'
+  days[nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1)] = 'Thanksgiving Day'
+  # Christmas Eve, unless that is a weekend or the observed holiday
+  christmas_eve = datetime.date(year, 12, 24)
+  if christmas_eve.weekday() in [0, 1, 2, 3]:
+    days[christmas_eve] = 'Christmas Day'
+  return days
+
+def is_trading_day(day):
+  return day.weekday() < 5 and day not in holidays(day.year)
+
+def get_close_time(day):
+  if not is_trading_day(day):
+    return None
+  if day in early_closes(day.year):
+    return EARLY_CLOSE
+  return datetime.time(16, 0)
+
+def next_trading_day(day):
+  day += datetime.timedelta(days=1)
+  while not is_trading_day(day):
+    day += datetime.timedelta(days=1)
+  return day
@@ -0,0 +1,80 @@
+import json
+import os
+
+verbose = False
+
+# The MediaWiki API allows up to 50 titles per query (500 for bots, but let's not push our luck).
+BATCH_SIZE = 50
+
+def query_revisions(w, titles, rvprop):
+  # Yields (title, revision) for each title which exists, in batches of BATCH_SIZE.
+  for i in range(0, len(titles), BATCH_SIZE):
+    batch = titles[i:i+BATCH_SIZE]
+    data = w.get('query', titles='|'.join(batch), prop='revisions', rvprop=rvprop, rvslots='main', formatversion=2)
+    query = data.get('query', {})
+    # The API may rename titles (e.g. 'User:darkid/Foo' -> 'User:Darkid/Foo'), so map them back to what was requested.
+    normalized = {n['to']: n['from'] for n in query.get('normalized', [])}
+    for page in query.get('pages', []):
+      title = normalized.get(page['title'], page['title'])
+      if page.get('missing') or not page.get('revisions'):
+        print(f'Could not load revisions for {title}')
+        continue
+      yield (title, page['revisions'][0])
+
+def fetch_revision_ids(w, titles):
+  return {title: revision['revid'] for title, revision in query_revisions(w, titles, 'ids')}
+
+def fetch_contents(w, titles):
+  contents = {}
+  for title, revision in query_revisions(w, titles, 'ids|content'):
+    contents[title] = (revision['revid'], revision['slots']['main']['content'])
+  return contents
+
+class PageCache:
+  # title: {'revid': revision id, 'value': anything JSON-serializable derived from the text}
+  # Since a revision never changes, anything derived from it can be reused for as long as the revision ID matches.
+  # The text itself isn't kept, so that the cache doesn't grow with the size of every page.
+  # If the version doesn't match what's on disk, the cached values are stale and get discarded.
+  def __init__(self, path, version=1):
+    self.path = path
+    self.version = version
+    self.entries = {}
+    if os.path.exists(path):
+      with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+      if data.get('version') == version:
+        self.entries = data['entries']
+
+  def get(self, title, revid):
+    entry = self.entries.get(title)
+    if entry and entry['revid'] == revid:
+      return entry
+    return None
+
+  def set(self, title, revid, value):
+    self.entries[title] = {'revid': revid, 'value': value}
+
+  def save(self):
+    with open(self.path, 'w', encoding='utf-8') as f:
+      json.dump({'version': self.version, 'entries': self.entries}, f)
+
+  def fetch(self, w, titles):
+    # Returns [(title, revid, text, cached value)] in the same order as titles, with None for titles which don't exist.
+    # Only pages which have changed are downloaded, with a value of None since it needs to be derived again.
+    # Unchanged pages have their cached value, and a text of None.
+    revids = fetch_revision_ids(w, titles)
+    stale = [title for title, revid in revids.items() if not self.get(title, revid)]
+    if verbose:
+      print(f'{len(revids) - len(stale)} of {len(revids)} pages are unchanged since the last run')
+    contents = fetch_contents(w, stale)
+
+    results = []
+    for title in titles:
+      if title in contents:
+        revid, text = contents[title]
+        results.append((title, revid, text, None))
+      elif title in revids and (entry := self.get(title, revids[title])):
+        results.append((title, entry['revid'], None, entry['value']))
+      else:
+        results.append(None)
+    return results
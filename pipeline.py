@@ -0,0 +1,111 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+
+import instrumentation
+
+# A small staged pipeline. Each stage applies a function to every item, using its own pool of workers,
+# and stages are connected by bounded queues so that a fast stage can't run arbitrarily far ahead of a slow one.
+# Results come out in the same order that the items went in, no matter which worker finished first.
+#
+# func: called with one item (or a list of up to batch_size items, in which case it returns a list of results, in order).
+# workers: how many items (or batches) are processed at once.
+# processes: run func on a process pool instead of on threads, for CPU-bound work. func (and its items) must be picklable.
+Stage = collections.namedtuple('Stage', ['name', 'func', 'workers', 'batch_size', 'processes'], defaults=[1, None, False])
+
+QUEUE_SIZE = 100 # Items waiting between each pair of stages
+DONE = object() # Sent once per worker, when there are no more items
+
+class Failure:
+  # Wraps an exception from a stage, so that it can be passed through the rest of the pipeline (and raised in order)
+  def __init__(self, stage, exception):
+    self.stage = stage
+    self.exception = exception
+
+def run_stage(stage, executor, inbox, outbox, remaining, lock, next_workers):
+  def call(func, arg):
+    with instrumentation.timer(f'pipeline.{stage.name}'):
+      if executor:
+        return executor.submit(func, arg).result()
+      return func(arg)
+
+  while True:
+    item = inbox.get()
+    if item is DONE:
+      break
+    batch = [item]
+    while stage.batch_size and len(batch) < stage.batch_size:
+      try:
+        item = inbox.get_nowait()
+      except queue.Empty:
+        break
+      if item is DONE:
+        inbox.put(DONE) # Leave it for the next get, once this batch is done
+        break
+      batch.append(item)
+
+    todo = [(i, value) for i, value in batch if not isinstance(value, Failure)]
+    try:
+      if stage.batch_size:
+        results = call(stage.func, [value for _, value in todo])
+        if len(results) != len(todo):
+          raise ValueError(f'Stage {stage.name} returned {len(results)} results for {len(todo)} items')
+      else:
+        results = [call(stage.func, value) for _, value in todo]
+      results = dict(zip((i for i, _ in todo), results))
+    except Exception as e:
+      results = {i: Failure(stage.name, e) for i, _ in todo}
+
+    for i, value in batch:
+      outbox.put((i, results.get(i, value)))
+
+  with lock:
+    remaining[stage.name] -= 1
+    if remaining[stage.name] == 0: # The last worker for this stage tells the next stage that there's nothing more coming
+      for _ in range(next_workers):
+        outbox.put(DONE)
+
+def run(items, stages, queue_size=QUEUE_SIZE):
+  # Yields the result of passing each item through every stage, in order. If any stage raised an exception for an item,
+  # it is raised here when that item comes up (at which point the remaining workers are abandoned, since they're daemons).
+  queues = [queue.Queue(queue_size) for _ in stages] + [queue.Queue()]
+  remaining = {stage.name: stage.workers for stage in stages}
+  lock = threading.Lock()
+  executors = []
+  threads = []
+  for s, stage in enumerate(stages):
+    executor = None
+    if stage.processes:
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=stage.workers)
+      executors.append(executor)
+    next_workers = stages[s + 1].workers if s + 1 < len(stages) else 1
+    for _ in range(stage.workers):
+      thread = threading.Thread(target=run_stage, args=(stage, executor, queues[s], queues[s + 1], remaining, lock, next_workers), daemon=True)
+      thread.start()
+      threads.append(thread)
+
+  def feed():
+    for i, item in enumerate(items):
+      queues[0].put((i, item))
+    for _ in range(stages[0].workers):
+      queues[0].put(DONE)
+  threading.Thread(target=feed, daemon=True).start()
+
+  try:
+    pending = {} # Results which finished before an earlier item
+    next_index = 0
+    while True:
+      result = queues[-1].get()
+      if result is DONE:
+        break
+      pending[result[0]] = result[1]
+      while next_index in pending:
+        value = pending.pop(next_index)
+        if isinstance(value, Failure):
+          raise value.exception
+        yield value
+        next_index += 1
+  finally:
+    for executor in executors:
+      executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,142 @@
+import base64
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import threading
+import urllib.parse
+
+import requests
+
+verbose = False
+
+# Record/replay for HTTP traffic, so that a full run can be repeated offline, in milliseconds, and with the same results.
+# This hooks requests.Session.send, which sits under both dow_jones.get_url and the wiki client, so the real parsers still run.
+#   python main.py --record fixtures/2024-05-01.json.gz  # A normal run, which also saves every response
+#   python main.py --replay fixtures/2024-05-01.json.gz  # Serves those responses back, with no network at all
+#
+# Requests are matched on method, url and body. Identical requests (e.g. polling the same source) get their responses
+# back in the order they were recorded, and then the last one repeats. A request which wasn't recorded fails with a
+# ConnectionError, just like it would if the site was down.
+#
+# Fixtures may end up in the repo, so passwords and tokens are left out of the body before it's hashed,
+# and cookies aren't saved.
+
+FORMAT_VERSION = 1
+SECRET_PARAMS = ('password', 'token') # Any form parameter containing one of these
+SECRET_HEADERS = {'set-cookie'}
+
+original_send = requests.Session.send
+
+def request_key(request):
+  body = request.body or b''
+  if isinstance(body, str):
+    body = body.encode('utf-8')
+  if request.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+    params = urllib.parse.parse_qsl(body.decode('utf-8'), keep_blank_values=True)
+    params = [(name, value) for name, value in params if not any(secret in name.lower() for secret in SECRET_PARAMS)]
+    body = urllib.parse.urlencode(params).encode('utf-8')
+  return f'{request.method} {request.url} {hashlib.sha1(body).hexdigest()}'
+
+def to_entry(key, response):
+  return {
+    'key': key,
+    'status': response.status_code,
+    'reason': response.reason,
+    'headers': {name: value for name, value in response.headers.items() if name.lower() not in SECRET_HEADERS},
+    'content': base64.b64encode(response.content).decode('ascii'),
+  }
+
+def from_entry(entry, request):
+  response = requests.Response()
+  response.status_code = entry['status']
+  response.reason = entry['reason']
+  response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+  response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+  response.url = request.url
+  response.request = request
+  response.elapsed = datetime.timedelta(0)
+  # Already 'downloaded', so stream=True callers iterate over the content instead of reading from a socket.
+  response._content = base64.b64decode(entry['content'])
+  response._content_consumed = True
+  return response
+
+class Recorder:
+  def __init__(self, path, **metadata):
+    self.path = path
+    self.metadata = metadata # Saved alongside the responses, e.g. the date of the run
+    self.lock = threading.Lock()
+    self.entries = []
+
+  def send(self, session, request, **kwargs):
+    response = original_send(session, request, **kwargs)
+    entry = to_entry(request_key(request), response) # Reads the whole body, even for stream=True
+    with self.lock:
+      self.entries.append(entry)
+    return response
+
+  def save(self):
+    with self.lock:
+      data = {'version': FORMAT_VERSION, 'metadata': self.metadata, 'entries': self.entries}
+    with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+      json.dump(data, f)
+    if verbose:
+      print(f'Recorded {len(self.entries)} HTTP responses to {self.path}')
+
+class Replayer:
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+      data = json.load(f)
+    if data.get('version') != FORMAT_VERSION:
+      raise ValueError(f'{path} is in an unsupported format: {data.get("version")}')
+    self.metadata = data['metadata']
+    self.responses = collections.defaultdict(list) # key: [entry], in the order they were recorded
+    for entry in data['entries']:
+      self.responses[entry['key']].append(entry)
+    self.misses = []
+
+  def send(self, session, request, **kwargs):
+    key = request_key(request)
+    with self.lock:
+      entries = self.responses.get(key)
+      if not entries:
+        self.misses.append(key)
+        raise requests.ConnectionError(f'No recorded response for {request.method} {request.url}', request=request)
+      entry = entries.pop(0) if len(entries) > 1 else entries[0]
+    return from_entry(entry, request)
+
+  def save(self):
+    # Nothing to save, but this is a good time to mention anything which didn't match (e.g. because the code changed).
+    if self.misses and verbose:
+      print(f'{len(self.misses)} requests had no recorded response in {self.path}:')
+      for key in self.misses:
+        print(f'  {key}')
+
+class ReplayClock:
+  # Stands in for the time module in dow_jones (see dow_jones.clock): time only moves when something sleeps, so waiting
+  # between polls is instant, but the polls still happen in the same order as they did in the recorded run.
+  def __init__(self):
+    self.now = 0.0
+
+  def monotonic(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += max(seconds, 0)
+
+def install(mode, path, **metadata):
+  # mode is 'record' or 'replay'. Returns the Recorder or Replayer; call save() on it when the run is over.
+  if mode == 'record':
+    recorder = Recorder(path, **metadata)
+  elif mode == 'replay':
+    recorder = Replayer(path)
+  else:
+    raise ValueError(f'Unknown mode: {mode}')
+  requests.Session.send = lambda session, request, **kwargs: recorder.send(session, request, **kwargs)
+  return recorder
+
+def uninstall():
+  requests.Session.send = original_send
@@ -0,0 +1,173 @@
+import datetime
+import functools
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+import zoneinfo
+
+import dow_history
+import main
+import nyse_calendar
+import spatial
+
+verbose = False
+
+# A small JSON service, so that other tools (maps, chat bots, equvix.html) can get geohashes without running the whole bot.
+#   /geohash?date=2024-05-01&lat=47&lon=-122   The geohash in the given graticule
+#   /centicule?date=2024-05-01&lon=-122        Just the centicule (which only depends on the 30W rule, so lat is optional)
+#   /globalhash?date=2024-05-01
+# date defaults to today (Eastern time). Graticules use the wiki's names, so '-0' and '0' are different graticules.
+#
+# Dow opens come from the local history file, which the daily run keeps up to date. Computed hashes are kept in an LRU,
+# so repeated requests (which is most of them, since everyone wants today's hash) are just a dict lookup.
+# Usage: python server.py [port]
+
+DOW_HISTORY_PATH = os.environ.get('DOW_HISTORY_PATH', 'dow_history.bin')
+PORT = 8000
+CACHE_SIZE = 4096
+EASTERN_TIME = zoneinfo.ZoneInfo('America/New_York')
+
+GRATICULE = re.compile(r'^-?\d{1,3}$')
+
+class HttpError(Exception):
+  def __init__(self, status, message):
+    super().__init__(message)
+    self.status = status
+
+class GeohashService:
+  def __init__(self, history):
+    self.history = history
+    self.lock = threading.Lock() # The history is remapped when it's refreshed, so reads can't overlap with that.
+    # Misses raise instead of returning, so that they aren't cached (the open for today may show up later).
+    self.get_geohash = functools.lru_cache(maxsize=CACHE_SIZE)(self.compute_geohash)
+
+  def get_open_date(self, day, w30):
+    # The trading day whose open this geohash should use. Unscheduled closures aren't in the calendar, which is fine,
+    # since we only use this to decide whether the open has been published yet.
+    date = day.date()
+    if not w30 and day >= main.W30_RULE_START:
+      date -= datetime.timedelta(days=1)
+    while not nyse_calendar.is_trading_day(date):
+      date -= datetime.timedelta(days=1)
+    return date.isoformat()
+
+  def compute_geohash(self, date, w30):
+    day = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+    open_date = self.get_open_date(day, w30)
+    with self.lock:
+      latest = self.history.latest()
+      if latest is None or latest < open_date:
+        self.history.refresh()
+        latest = self.history.latest()
+      if latest is None or latest < open_date:
+        raise HttpError(404, f'The DOW open for {open_date} is not known yet')
+      dow_open = main.get_dow_open(self.history, day, w30)
+    if not dow_open:
+      raise HttpError(404, f'No DOW open could be found for {date}')
+    return main.Geohash(*main.hash_geohash(day, dow_open), dow_open)
+
+  def geohash(self, params):
+    date = parse_date(params)
+    lat, long = parse_graticule(params, 'lat'), parse_graticule(params, 'lon')
+    w30 = int(long) < -30
+    geohash = self.get_geohash(date, w30)
+    latitude, longitude = spatial.graticule_point((lat, long), geohash.latitude, geohash.longitude)
+    return {
+      'date': date.isoformat(),
+      'graticule': [lat, long],
+      'latitude': latitude,
+      'longitude': longitude,
+      'centicule': geohash.centicule,
+      'w30': w30,
+      'dow_open': geohash.dow_open,
+    }
+
+  def centicule(self, params):
+    date = parse_date(params)
+    w30 = int(parse_graticule(params, 'lon')) < -30
+    return {'date': date.isoformat(), 'w30': w30, 'centicule': self.get_geohash(date, w30).centicule}
+
+  def globalhash(self, params):
+    date = parse_date(params)
+    globalhash = main.get_globalhash(self.get_geohash(date, False))
+    return {
+      'date': date.isoformat(),
+      'latitude': globalhash.latitude,
+      'longitude': globalhash.longitude,
+      'graticule': list(globalhash.graticule),
+      'centicule': globalhash.centicule,
+    }
+
+def parse_date(params):
+  if 'date' not in params:
+    return datetime.datetime.now(tz=EASTERN_TIME).date()
+  try:
+    date = datetime.date.fromisoformat(params['date'])
+  except ValueError:
+    raise HttpError(400, f'Invalid date: "{params["date"]}", expected YYYY-MM-DD')
+  if date < dow_history.EPOCH: # Also keeps the date arithmetic in get_open_date from going below year 1
+    raise HttpError(400, f'Invalid date: "{params["date"]}", the DOW history starts on {dow_history.EPOCH.isoformat()}')
+  return date
+
+def parse_graticule(params, name):
+  value = params.get(name)
+  if value is None:
+    raise HttpError(400, f'Missing parameter: {name}')
+  limit = 90 if name == 'lat' else 180
+  if not GRATICULE.match(value) or abs(int(value)) >= limit:
+    raise HttpError(400, f'Invalid graticule: {name}={value}')
+  return value
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' # Keep-alive, so that busy clients don't pay for a new connection per request
+  disable_nagle_algorithm = True # Otherwise the body waits on a delayed ACK for the headers, which adds ~40ms per request
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    routes = {
+      '/geohash': self.server.service.geohash,
+      '/centicule': self.server.service.centicule,
+      '/globalhash': self.server.service.globalhash,
+    }
+    try:
+      if url.path not in routes:
+        raise HttpError(404, f'Unknown path: {url.path}')
+      status, body = 200, routes[url.path](params)
+    except HttpError as e:
+      status, body = e.status, {'error': str(e)}
+
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.send_header('Access-Control-Allow-Origin', '*') # For equvix.html, which is served from github.io
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    if verbose:
+      super().log_message(format, *args)
+
+class GeohashServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, history):
+    super().__init__(address, Handler)
+    self.service = GeohashService(history)
+
+if __name__ == '__main__':
+  verbose = True
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+  with dow_history.DowHistory(DOW_HISTORY_PATH) as history:
+    server = GeohashServer(('', port), history)
+    print(f'Serving geohashes on port {port}, using DOW history from {DOW_HISTORY_PATH}')
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    server.server_close()
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+import time
+
+verbose = False
+
+# Persisted health stats for each dow source, so that we query reliable, fast sources first,
+# and stop paying for (and printing tracebacks from) sources which have been broken for weeks.
+#
+# Stats are exponentially weighted, so that a source which recovers (or breaks) is noticed within a few polls.
+# A source which fails several times in a row is put on a cooldown, which doubles for every further failure.
+# Once the cooldown expires, the source is tried again, and a single success clears it.
+
+ALPHA = 0.2 # Weight of the newest sample in each average
+COOLDOWN_AFTER = 3 # Consecutive failures before a source is put on cooldown
+COOLDOWN = 6 * 60 * 60 # Seconds, for the first cooldown
+MAX_COOLDOWN = 7 * 24 * 60 * 60
+
+# Sources we haven't seen before start out as 'probably fine'
+DEFAULT_STATS = {
+  'success_rate': 0.5,
+  'latency': 10.0, # Seconds
+  'agreement': 1.0, # How often the source's opens matched the quorum
+  'failures': 0, # Consecutive
+  'cooldown_until': 0, # time.time()
+}
+
+class SourceHealth:
+  def __init__(self, path=None):
+    self.path = path # If None, stats are only kept in memory
+    self.lock = threading.Lock()
+    self.stats = {} # source name: stats
+    if path and os.path.exists(path):
+      with open(path, 'r', encoding='utf-8') as f:
+        self.stats = json.load(f)
+
+  def save(self):
+    if not self.path:
+      return
+    with self.lock:
+      with open(self.path, 'w', encoding='utf-8') as f:
+        json.dump(self.stats, f, indent=2, sort_keys=True)
+
+  def get(self, name):
+    return {**DEFAULT_STATS, **self.stats.get(name, {})}
+
+  def update(self, name, key, value):
+    # Caller must hold the lock
+    stats = self.stats.setdefault(name, dict(DEFAULT_STATS))
+    stats[key] = (1 - ALPHA) * stats.get(key, DEFAULT_STATS[key]) + ALPHA * value
+
+  def record_success(self, name, latency):
+    with self.lock:
+      self.update(name, 'success_rate', 1)
+      self.update(name, 'latency', latency)
+      self.stats[name]['failures'] = 0
+      self.stats[name]['cooldown_until'] = 0
+
+  def record_failure(self, name, latency):
+    with self.lock:
+      self.update(name, 'success_rate', 0)
+      self.update(name, 'latency', latency)
+      stats = self.stats[name]
+      stats['failures'] = stats.get('failures', 0) + 1
+      if stats['failures'] >= COOLDOWN_AFTER:
+        cooldown = min(COOLDOWN * 2 ** (stats['failures'] - COOLDOWN_AFTER), MAX_COOLDOWN)
+        stats['cooldown_until'] = time.time() + cooldown
+        if verbose:
+          print(f'{name} has failed {stats["failures"]} times in a row, not polling it for {cooldown / 3600:.0f} hours')
+
+  def record_agreement(self, name, agreed):
+    with self.lock:
+      self.update(name, 'agreement', 1 if agreed else 0)
+
+  def score(self, name):
+    # Higher is better: the chance that a request succeeds and is correct, discounted by how long it takes
+    stats = self.get(name)
+    return stats['success_rate'] * stats['agreement'] / (1 + stats['latency'] / 10)
+
+  def on_cooldown(self, name):
+    return self.get(name)['cooldown_until'] > time.time()
+
+  def rank(self, names, minimum=3):
+    # Returns the indices of the sources which should be polled, best first. Sources on cooldown are skipped,
+    # unless that would leave fewer than `minimum` sources (in which case we may as well try them).
+    ranked = sorted(range(len(names)), key=lambda i: self.score(names[i]), reverse=True) # Stable, so ties keep their original order
+    available = [i for i in ranked if not self.on_cooldown(names[i])]
+    cooling = [i for i in ranked if self.on_cooldown(names[i])]
+    return available + cooling[:max(minimum - len(available), 0)]
@@ -0,0 +1,50 @@
+import math
+
+# Geometry helpers for radius-based subscriptions.
+# Graticules are named the way the wiki does, as strings: the graticule from 0 to -1 degrees is '-0', not '0'.
+
+EARTH_RADIUS_KM = 6371.0088
+
+def distance_km(lat1, long1, lat2, long2):
+  # Haversine formula, see https://en.wikipedia.org/wiki/Haversine_formula
+  lat1, long1, lat2, long2 = map(math.radians, [lat1, long1, lat2, long2])
+  a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+def graticule_name(lower_bound):
+  # The graticule covering [lower_bound, lower_bound + 1) degrees
+  if lower_bound >= 0:
+    return str(lower_bound)
+  return '-' + str(-lower_bound - 1)
+
+def locate(latitude, longitude):
+  # The graticule and centicule containing a point, e.g. (45.67, -122.34) is in graticule ('45', '-122'), centicule '63'
+  graticule = (graticule_name(math.floor(latitude)), graticule_name(math.floor(longitude)))
+  centicule = f'{int(abs(latitude) % 1 * 10)}{int(abs(longitude) % 1 * 10)}'
+  return graticule, centicule
+
+def graticule_point(graticule, latitude, longitude):
+  # Combines a graticule with the fractional parts from get_geohash, exactly like the map links do.
+  lat, long = graticule
+  return (float(f'{lat}.{latitude}'), float(f'{long}.{longitude}'))
+
+def graticules_near(lat, long, radius_km):
+  # Every graticule which might overlap the circle. This is a bounding box, so it may include a few graticules in the corners.
+  angle = radius_km / EARTH_RADIUS_KM # Angular radius, in radians
+  lat_delta = math.degrees(angle)
+  lat_min = max(lat - lat_delta, -90)
+  lat_max = min(lat + lat_delta, 90)
+  if lat_min <= -90 or lat_max >= 90 or angle >= math.pi / 2:
+    long_delta = 180 # Contains a pole, so every longitude is in range
+  else:
+    # The widest point of a circle on a sphere is not at its center latitude, see http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+    long_delta = min(math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat)))), 180)
+
+  lat_bounds = range(math.floor(lat_min), min(math.floor(lat_max), 89) + 1)
+  if long_delta >= 180:
+    long_bounds = range(-180, 180)
+  else:
+    # Wrap around the antimeridian
+    long_bounds = sorted({(b + 180) % 360 - 180 for b in range(math.floor(long - long_delta), math.floor(long + long_delta) + 1)})
+
+  return [(graticule_name(lat_bound), graticule_name(long_bound)) for lat_bound in lat_bounds for long_bound in long_bounds]
@@ -1,11 +1,38 @@
 # A very light smattering of tests
+import base64
+import collections
 import datetime
+import gzip
+import html
 import inspect
+import json
 import os
+import random
+import re
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import requests
 
 import main
+import bulk_geohash
+import dispatch
+import dow_history
 import dow_jones
+import html_tables
+import instrumentation
+import nyse_calendar
+import page_cache
+import pipeline
+import replay
+import server
+import source_health
+import spatial
 
 _id = 0
 def get_id():
@@ -15,21 +42,53 @@ def get_id():
 
 class MockPage:
   def __init__(self, wiki, title):
+    self.wiki = wiki
     self.title = title
+    self.basename = title
     self.wikitext = f'default for {self.title}'
+    self.revid = get_id()
 
   def get_wiki_text(self):
     return self.wikitext
 
+  def __str__(self):
+    return self.title
+
   def get_edit_url(self):
     return 'https://edit.url/' + self.title.replace(' ', '_')
 
+  def get_page_url(self):
+    return 'https://page.url/' + self.title.replace(' ', '_')
+
   def edit(self, contents, **kwargs):
     self.wikitext = contents
+    self.revid = get_id()
+    if self.wiki:
+      self.wiki.edits.append((self.title, contents))
+      self.wiki.maxlags.append(kwargs.get('maxlag'))
 
 class MockWiki:
   def __init__(self):
     self.category_pages = []
+    self.queries = []
+    self.edits = []
+    self.emails = []
+    self.maxlags = [] # From each edit and email
+
+  def get(self, action, **kwargs):
+    self.queries.append(kwargs)
+    assert action == 'query' and kwargs['prop'] == 'revisions'
+    pages = {page.title: page for page in self.category_pages}
+    results = []
+    for title in kwargs['titles'].split('|'):
+      if title not in pages:
+        results.append({'title': title, 'missing': True})
+        continue
+      revision = {'revid': pages[title].revid}
+      if 'content' in kwargs['rvprop']:
+        revision['slots'] = {'main': {'content': pages[title].wikitext}}
+      results.append({'title': title, 'revisions': [revision]})
+    return {'query': {'pages': results}}
 
   def get_all_category_pages(self, *args, **kwargs):
     return self.category_pages
@@ -37,6 +96,10 @@ class MockWiki:
   def login(self, username, password):
     return True
 
+  def email_user(self, user, title, contents, **kwargs):
+    self.emails.append((user, contents))
+    self.maxlags.append(kwargs.get('maxlag'))
+
 class Tests:
   dow_opens = {
       '2024-05-07': '38858.94',
@@ -100,6 +163,62 @@ class Tests:
     assert long == '5890366767633993'
     assert cent == '05'
 
+  def test_geohash_table(self):
+    days = [datetime.datetime(2024, 4, 30, tzinfo=datetime.timezone.utc) + datetime.timedelta(days=i) for i in range(7)]
+    table = main.GeohashTable(self.dow_opens, days)
+    for day in days:
+      assert table.get(day)[:3] == main.get_geohash(self.dow_opens, day)
+      assert table.get(day, w30 = False)[:3] == main.get_geohash(self.dow_opens, day, w30 = False)
+
+    geohash = table.get(datetime.datetime(2024, 5, 4, tzinfo=datetime.timezone.utc))
+    assert geohash.centicule == '84'
+    assert geohash.dow_open == '38709.36'
+    geohash = table.get(datetime.datetime(2024, 5, 6, tzinfo=datetime.timezone.utc), w30 = False)
+    assert geohash.centicule == '05'
+    assert geohash.dow_open == '38709.36'
+
+  def test_bulk_geohash(self):
+    start = datetime.date(2024, 4, 20)
+    end = datetime.date(2024, 5, 10)
+    process_threshold = bulk_geohash.PROCESS_THRESHOLD
+    for threshold, workers in [(process_threshold, None), (0, 2)]: # The process pool is only used for a lot of hashes
+      bulk_geohash.PROCESS_THRESHOLD = threshold
+      geohashes = bulk_geohash.get_geohashes(self.dow_opens, start, end, workers=workers, chunk_size=8)
+      assert len(geohashes) == 21
+      for i, day in enumerate(geohashes.days):
+        if day.date() < datetime.date(2024, 4, 22):
+          assert geohashes.get(i) is None # No DOW data yet
+          continue
+        assert geohashes.get(i, w30 = True) == main.get_geohash(self.dow_opens, day, w30 = True)
+        if day.date() > datetime.date(2024, 4, 22):
+          assert geohashes.get(i, w30 = False) == main.get_geohash(self.dow_opens, day, w30 = False)
+    bulk_geohash.PROCESS_THRESHOLD = process_threshold
+
+    assert geohashes.days[14].date() == datetime.date(2024, 5, 4)
+    assert geohashes.w30.centicule[14] == '84'
+    assert str(geohashes.w30.latitude[14]) == '0.8657127823310143'
+
+  def test_bulk_geohash_speed(self):
+    # Years of (random) opens, across the start of the 30W rule and with a few missing days. This should match
+    # main.get_geohash for every day, and be much faster than calling it for every day.
+    rng = random.Random(0)
+    dow_opens = {}
+    day = datetime.date(2003, 12, 1)
+    while day <= datetime.date(2012, 12, 31):
+      if day.weekday() < 5 and rng.random() > 0.03:
+        dow_opens[day.isoformat()] = f'{rng.randint(6000, 14000)}.{rng.randint(0, 99):02}'
+      day += datetime.timedelta(days=1)
+
+    start = time.perf_counter()
+    geohashes = bulk_geohash.get_geohashes(dow_opens, datetime.date(2004, 1, 1), datetime.date(2012, 12, 31))
+    bulk_time = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = [(main.get_geohash(dow_opens, day, w30 = True), main.get_geohash(dow_opens, day, w30 = False)) for day in geohashes.days]
+    loop_time = time.perf_counter() - start
+
+    assert [(geohashes.get(i, w30 = True), geohashes.get(i, w30 = False)) for i in range(len(geohashes))] == expected
+    assert bulk_time < loop_time / 3, (bulk_time, loop_time)
+
   def test_parse_config(self):
     text = '''
     {| border="1" cellpadding="5" cellspacing="0"
@@ -121,6 +240,52 @@ class Tests:
     assert config['saturday'][(47, -122)]['50'] == {'email': True, 'config_page': True}
     assert config['saturday'][(47, -122)]['61'] == {'email': True, 'config_page': True}
 
+  def test_dow_from_marketwatch(self):
+    text = '<meta name="quoteTime" content="Jun 18, 2025 9:30 a.m."><mw-rangebar day-open="42,215.80" day-close="">'
+    get_url = dow_jones.get_url
+    dow_jones.get_url = lambda url: text
+    try:
+      assert list(dow_jones.dow_from_marketwatch()) == [(datetime.datetime(2025, 6, 18), '42215.80')]
+    finally:
+      dow_jones.get_url = get_url
+
+  def test_dow_validators(self):
+    # A page that can't be parsed should be fetched (and fail) again on the next poll, rather than being 'not modified'
+    class Response:
+      def __init__(self, text):
+        self.status_code, self.ok, self.headers = 200, True, {}
+        self.text, self.content = text, text.encode('utf-8')
+      def raise_for_status(self):
+        pass
+    class Session:
+      text = ''
+      def get(self, url, **kwargs):
+        return Response(self.text)
+
+    session = Session()
+    dow_jones.session = session
+    dow_jones.validators.clear()
+    name = dow_jones.dow_from_businessinsider.__name__
+    try:
+      session.text = '<html>A redesign</html>'
+      for failures in range(1, 4):
+        try:
+          dow_jones.fetch_source(dow_jones.dow_from_businessinsider)
+          assert False, 'Should have raised'
+        except ValueError:
+          pass
+        assert dow_jones.health.get(name)['failures'] == failures
+      assert dow_jones.health.on_cooldown(name)
+
+      session.text = 'historicalPrices: {"model": [{"Date": "01/02/20", "Open": 28638.97}]}\n'
+      assert dow_jones.fetch_source(dow_jones.dow_from_businessinsider) == [('2020-01-02', '28638.97')]
+      assert dow_jones.health.get(name)['failures'] == 0
+      # Now it's unchanged, so the rows from the last fetch are used
+      assert dow_jones.fetch_source(dow_jones.dow_from_businessinsider) == [('2020-01-02', '28638.97')]
+    finally:
+      dow_jones.session = None
+      dow_jones.validators.clear()
+
   def test_dow_quorum(self):
     source1 = [(datetime.datetime(2020, 1, 1), 100)]
     source2 = [(datetime.datetime(2020, 1, 1), 100)]
@@ -153,6 +318,207 @@ class Tests:
     source3 = []
     assert dow_jones.get_dow_jones_opens() == {}
 
+  def test_dow_early_quorum(self):
+    def slow_source():
+      time.sleep(0.5)
+      return [(datetime.datetime(2020, 1, 1), 102)]
+    def broken_source():
+      raise ValueError('Website is down')
+    fast_source = lambda: [(datetime.datetime(2020, 1, 1), 100)]
+    dow_jones.dow_sources = [slow_source, broken_source, fast_source, fast_source]
+
+    start = time.time()
+    assert dow_jones.get_dow_jones_opens('2020-01-01') == {'2020-01-01': 100}
+    assert time.time() - start < 0.5
+
+    # Without a requested date, we wait for every source
+    assert dow_jones.get_dow_jones_opens() == {'2020-01-01': 100}
+    assert time.time() - start >= 0.5
+
+  def test_dow_poller(self):
+    calls = collections.Counter()
+    def make_source(name, rows_by_poll):
+      def source():
+        calls[name] += 1
+        rows = rows_by_poll[min(calls[name], len(rows_by_poll)) - 1]
+        if rows is None:
+          raise ValueError('Website is down')
+        return rows
+      return source
+
+    yesterday = (datetime.datetime(2020, 1, 1), 100)
+    today = (datetime.datetime(2020, 1, 2), 200)
+    dow_jones.dow_sources = [
+      make_source('early', [[yesterday, today]]),
+      make_source('late', [[yesterday], [yesterday], [yesterday, today]]),
+      make_source('broken', [None]),
+    ]
+
+    poller = dow_jones.DowPoller('2020-01-02', interval=0.01)
+    dow_opens = poller.wait(timeout=5)
+    assert dow_opens == {'2020-01-01': 100, '2020-01-02': 200}
+    assert calls['early'] == 1 # Already reported today, so never refetched
+    assert calls['late'] == 3
+    assert calls['broken'] < calls['late'] # Backed off after failing
+
+    # No quorum by the deadline
+    calls.clear()
+    dow_jones.dow_sources = [make_source('early', [[yesterday, today]]), make_source('late', [[yesterday]])]
+    poller = dow_jones.DowPoller('2020-01-02', interval=0.01)
+    assert poller.wait(timeout=0.1) == {'2020-01-01': 100}
+
+  def test_source_health(self):
+    health = source_health.SourceHealth(os.path.join(tempfile.mkdtemp(), 'source_health.json'))
+    names = ['new', 'slow', 'flaky', 'good', 'dead']
+    for _ in range(5):
+      health.record_success('good', 1)
+      health.record_success('slow', 25)
+      health.record_failure('dead', 30)
+    health.record_success('flaky', 1)
+    health.record_failure('flaky', 1)
+    health.record_agreement('good', True)
+    health.record_agreement('slow', False)
+
+    assert health.on_cooldown('dead')
+    assert not health.on_cooldown('flaky')
+    assert health.rank(names) == [3, 2, 0, 1] # good, flaky (but fast), new, slow. dead is on cooldown.
+    assert health.rank(names[3:]) == [0, 1] # ... unless there aren't enough other sources
+
+    health.save()
+    reloaded = source_health.SourceHealth(health.path)
+    assert reloaded.rank(names) == [3, 2, 0, 1]
+    reloaded.record_success('dead', 1) # Cooldown is cleared as soon as it works again
+    assert not reloaded.on_cooldown('dead')
+
+    # The poller skips sources on cooldown
+    calls = collections.Counter()
+    def make_source(name, dow):
+      def source():
+        calls[name] += 1
+        return [(datetime.datetime(2020, 1, 2), dow)]
+      source.__name__ = name
+      return source
+    dow_jones.health = source_health.SourceHealth()
+    for _ in range(source_health.COOLDOWN_AFTER):
+      dow_jones.health.record_failure('d', 1)
+    dow_jones.dow_sources = [make_source('a', 100), make_source('b', 100), make_source('c', 999), make_source('d', 100)]
+    assert dow_jones.DowPoller('2020-01-02').wait(timeout=5) == {'2020-01-02': 100}
+    assert calls['d'] == 0
+
+    dow_jones.record_agreement([('a', [('2020-01-02', 100)]), ('c', [('2020-01-01', 1), ('2020-01-02', 999)])], {'2020-01-02': 100})
+    assert dow_jones.health.get('c')['agreement'] < dow_jones.health.get('a')['agreement']
+
+  def test_nyse_calendar(self):
+    assert nyse_calendar.easter(2024) == datetime.date(2024, 3, 31)
+    assert nyse_calendar.easter(2025) == datetime.date(2025, 4, 20)
+    assert nyse_calendar.easter(2038) == datetime.date(2038, 4, 25)
+
+    assert sorted(nyse_calendar.holidays(2024)) == [
+      datetime.date(2024, 1, 1),
+      datetime.date(2024, 1, 15),
+      datetime.date(2024, 2, 19),
+      datetime.date(2024, 3, 29),
+      datetime.date(2024, 5, 27),
+      datetime.date(2024, 6, 19),
+      datetime.date(2024, 7, 4),
+      datetime.date(2024, 9, 2),
+      datetime.date(2024, 11, 28),
+      datetime.date(2024, 12, 25),
+    ]
+    assert sorted(nyse_calendar.early_closes(2024)) == [datetime.date(2024, 7, 3), datetime.date(2024, 11, 29), datetime.date(2024, 12, 24)]
+
+    # Observed dates
+    assert nyse_calendar.is_trading_day(datetime.date(2021, 12, 31)) # New Year's on a saturday is not observed
+    assert not nyse_calendar.is_trading_day(datetime.date(2021, 7, 5))
+    assert not nyse_calendar.is_trading_day(datetime.date(2022, 6, 20))
+    assert not nyse_calendar.is_trading_day(datetime.date(2022, 12, 26))
+    assert not nyse_calendar.is_trading_day(datetime.date(2025, 1, 9))
+    assert nyse_calendar.get_close_time(datetime.date(2023, 7, 3)) == datetime.time(13, 0)
+    assert nyse_calendar.get_close_time(datetime.date(2021, 12, 23)) == datetime.time(16, 0)
+
+    assert nyse_calendar.next_trading_day(datetime.date(2024, 3, 28)) == datetime.date(2024, 4, 1) # Good Friday
+    assert nyse_calendar.next_trading_day(datetime.date(2024, 5, 24)) == datetime.date(2024, 5, 28) # Memorial Day
+    assert nyse_calendar.next_trading_day(datetime.date(2019, 12, 31)) == datetime.date(2020, 1, 2)
+
+  def test_end2end_holiday(self):
+    dow_jones.dow_sources = [] # We should never need to poll
+
+    wiki = MockWiki()
+    page = MockPage(wiki, 'category_page')
+    page.wikitext = '| 0 || -100 || 12'
+    wiki.category_pages = [page]
+    main.main(wiki, datetime.datetime(2020, 1, 1, 13, 30, tzinfo=datetime.timezone.utc))
+    assert page.wikitext == '| 0 || -100 || 12'
+
+  def test_html_table_rows(self):
+    # Tables only count if they're on one line, like the old regexes (see html_tables.find_table)
+    page = '\n'.join([
+      '<html><body><table class="nav">',
+      '  <tr><td>Navigation</td></tr>',
+      '</table>',
+      '<table><tr><td>Menu<table><tr><td>Submenu</td></tr></table></td></tr></table>',
+      ''.join([
+        '<table class="history">',
+        '<thead><tr><th>Date</th><th>Open</th></tr></thead>',
+        '<tr><td><time dateTime="May 07, 2024">05/07/2024</time></td><td>38,858.94</td></tr>',
+        '<tr><td><span>Monday, May 06, 2024</span><span>Mon, May 06</span></td><td>38,762.43</td></tr>',
+        '<tr><td><table><tr><td>Nested</td></tr></table>May 03, 2024</td><td>38,709.36 &amp; more</td></tr>',
+        '<tr><td>May 02, 2024</td><td>38,075.65</td></tr>',
+        '</table>',
+      ]),
+      '<table><tr><td>Footer</td></tr></table>',
+    ])
+
+    chunks = [page[i:i+7] for i in range(0, len(page), 7)]
+    rows = list(html_tables.iter_table_rows(iter(chunks), table_index=1))
+    assert len(rows) == 4
+    assert rows[0][0].attrs == {'datetime': 'May 07, 2024'}
+    assert rows[0][1].text == '38,858.94'
+    assert rows[1][0].parts == ['Monday, May 06, 2024', 'Mon, May 06']
+    assert rows[2][0].text == 'May 03, 2024'
+    assert rows[2][1].text == '38,709.36 & more'
+
+    # Stops reading once it has enough rows
+    consumed = []
+    def tracked_chunks():
+      for chunk in chunks:
+        consumed.append(chunk)
+        yield chunk
+    rows = list(html_tables.iter_table_rows(tracked_chunks(), table_index=1, max_rows=2))
+    assert [row[1].text for row in rows] == ['38,858.94', '38,762.43']
+    assert len(consumed) * 7 < page.index('Footer')
+
+  def test_html_tables_old_regex(self):
+    # The table_index for each source was tuned against the old regexes, so they have to pick the same tables
+    FIND_TABLE = re.compile('<table[^>]*>(.*?)</table>')
+    FIND_TABLE_ROWS = re.compile('<tr[^>]*>(.*?)</tr>')
+    FIND_TABLE_CELLS = re.compile('<td[^>]*>(.*?)</td>')
+    page = '\n'.join([
+      '<!DOCTYPE html><html><head><script>var layout = "<table";</script></head><body>',
+      '<table class="layout"',
+      '  style="width: 100%"><tr><td>Sidebar</td></tr>',
+      '</table>',
+      '<div><table><tr><td>Ad<table><tr><td>Nested ad</td></tr></table></td></tr></table></div>',
+      '<TABLE><tr><td>Uppercase</td></tr></TABLE>',
+      '<table class="summary"><tr><td>Prev. Close</td><td>28,462.14</td></tr></table>',
+      '<table',
+      '  class="history"><tr><td>Jan 02, 2020</td><td>28,638.97</td></tr><tr><td>Dec 31, 2019</td><td>28,414.64</td></tr></table>',
+      '<table class="related"><tr><td>S&amp;P 500</td><td>3,257.85</td></tr></table>',
+      '</body></html>',
+    ])
+
+    old_tables = FIND_TABLE.findall(page)
+    assert len(old_tables) == 4
+    for table_index, table in enumerate(old_tables):
+      old_rows = [cells for row in FIND_TABLE_ROWS.findall(table) if (cells := FIND_TABLE_CELLS.findall(row))]
+      chunks = [page[i:i+5] for i in range(0, len(page), 5)]
+      new_rows = list(html_tables.iter_table_rows(iter(chunks), table_index=table_index))
+      if table_index == 0:
+        # The old regex stopped at the nested table's end, but it's the same table
+        assert [[cell.text for cell in row] for row in new_rows] == [['Ad']]
+        continue
+      assert [[cell.text for cell in row] for row in new_rows] == [[html.unescape(cell) for cell in cells] for cells in old_rows]
+
   def test_parse_config_cents(self):
     text = '''
     | 1 || 2 || 03 04 05 06          || || Monday
@@ -180,6 +546,405 @@ class Tests:
     assert config['tuesday'][(1, 2)]['08'] == {'config_page': True, 'talkpage': True}
     assert config['tuesday'][(1, 2)]['09'] == {'config_page': True, 'talkpage': True}
 
+  def test_parse_config_bitmasks(self):
+    config = main.parse_config('| 1 || 2 || 00 07 99 x 123 || || Tuesday, Email\n| 1 || 2 || 07 || || Sunday')
+    subscription = config.graticules[('1', '2')]
+    assert subscription.masks[1 * 3 + 0] == (1 << 0) | (1 << 7) | (1 << 99) # tuesday, config_page
+    assert subscription.masks[1 * 3 + 1] == (1 << 0) | (1 << 7) | (1 << 99) # tuesday, email
+    assert subscription.masks[6 * 3 + 0] == (1 << 7) # sunday, config_page
+    assert sum(1 for mask in subscription.masks if mask) == 3
+
+    assert list(config) == ['tuesday', 'sunday']
+    assert list(config['tuesday'][('1', '2')]) == ['00', '07', '99']
+    assert 'monday' not in config
+    assert config['monday'] == {}
+    assert '7' not in config['tuesday'][('1', '2')]
+
+  def test_parse_config_order(self):
+    # Each day lists its graticules in the order they first appear for that day, like the config page does
+    config = main.parse_config('| 1 || 2 || 12 || || Monday\n| 3 || 4 || 12 || ||\n| 1 || 2 || 12 || ||')
+    assert list(config['monday']) == [('1', '2'), ('3', '4')]
+    assert list(config['tuesday']) == [('3', '4'), ('1', '2')]
+    assert list(main.config_from_json(main.config_to_json(config))['tuesday']) == [('3', '4'), ('1', '2')]
+
+  def test_spatial(self):
+    assert abs(spatial.distance_km(0, 0, 0, 1) - 111.2) < 0.1
+    assert spatial.distance_km(47.6, -122.3, 47.6, -122.3) == 0
+    assert spatial.graticule_point(('-0', '-100'), '5', '25') == (-0.5, -100.25)
+    assert spatial.locate(45.67, -122.34) == (('45', '-122'), '63')
+    assert spatial.locate(-0.25, 0.91) == (('-0', '0'), '29')
+
+    assert spatial.graticules_near(0.5, 0.5, 10) == [('0', '0')]
+    assert sorted(spatial.graticules_near(0.05, -0.05, 20)) == [('-0', '-0'), ('-0', '0'), ('0', '-0'), ('0', '0')]
+    # Wraps around the antimeridian
+    assert sorted(spatial.graticules_near(10.5, 179.95, 20)) == [('10', '-179'), ('10', '179')]
+    # Contains the pole, so every longitude is included
+    assert len(spatial.graticules_near(89.5, 0, 100)) == 2 * 360
+
+  def test_parse_config_radius(self):
+    config = main.parse_config('| 45 || -122 || || || radius=25km@45.52/-122.68, Email, Saturday\n| 1 || 2 || || || radius=10km@1.5/-200')
+    assert list(config.radius) == [(45.52, -122.68, 25.0)]
+    subscription = config.radius[(45.52, -122.68, 25.0)]
+    assert subscription.masks == [0, 0, 0, 0, 0, 0b011, 0]
+    assert subscription.get_methods(5) == {'config_page': True, 'email': True}
+    assert main.config_from_json(main.config_to_json(config)).radius[(45.52, -122.68, 25.0)].masks == subscription.masks
+
+  def test_parse_config_globalhash(self):
+    config = main.parse_config('| 53 || -101 || || || Globalhash, Email\n| 1 || 2 || 07 || || globalhash\n| 1 || 2 || 08 || ||')
+    assert list(config.graticules) == [('1', '2')]
+    assert list(config.globalhash.graticules) == [('53', '-101'), ('1', '2')]
+    assert config.globalhash.graticules[('53', '-101')].masks[1] == (1 << 100) - 1 # monday, email
+    assert list(config.globalhash['monday'][('1', '2')]) == ['07']
+    assert main.config_from_json(main.config_to_json(config)).globalhash == config.globalhash
+    assert main.parse_config('| 1 || 2 || 07 || ||').globalhash is None
+
+  def test_find_page_hits(self):
+    # The W30 geohash for 2020-01-02 is at (0.154, -100.217) in centicule 12, the E30 one is in centicule 72,
+    # and the globalhash is at (53.283, -101.031)
+    day = datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+    geohashes = main.GeohashTable({'2019-12-31': '28414.64', '2020-01-02': '28638.97'}, [day])
+    config = main.parse_config('\n'.join([
+      '| 0 || -100 || 12 || || Email',
+      '| 1 || -100 || 13 || ||',
+      '| 0 || 5 || 72 || ||',
+      '| 5 || 5 || || || radius=20km@1.1/-99.3, Talkpage',
+      '| 53 || -101 || 20 || || globalhash',
+    ]))
+    hits = main.find_page_hits(config, geohashes, [day])
+    assert list(hits) == [(day, '0', '-100'), (day, '0', '5'), (day, '1', '-99'), (day, 'global')]
+    assert hits[(day, '0', '-100')] == (day, (0, 0), ('0', '-100'), geohashes.get(day, True), {'config_page': True, 'email': True}, None)
+    assert hits[(day, '0', '5')] == (day, (0, 2), ('0', '5'), geohashes.get(day, False), {'config_page': True}, None)
+    _, order, graticule, _, notifications, distance = hits[(day, '1', '-99')]
+    assert (order, graticule, notifications) == ((1, 0), ('1', '-99'), {'config_page': True, 'talkpage': True})
+    assert 10 < distance < 12
+    assert hits[(day, 'global')] == (day, (2, (0, 0)), None, geohashes.get_global(day), {'config_page': True}, None)
+
+    # Nothing on other days of the week, unless the page subscribed to them
+    friday = day + datetime.timedelta(days=1)
+    geohashes = main.GeohashTable({'2020-01-02': '28638.97', '2020-01-03': '28634.88'}, [friday])
+    every_centicule = ' '.join(f'{cent:02}' for cent in range(100))
+    assert main.find_page_hits(main.parse_config(f'| 0 || -100 || {every_centicule} || || Saturday'), geohashes, [friday]) == {}
+    assert len(main.find_page_hits(main.parse_config(f'| 0 || -100 || {every_centicule} || ||'), geohashes, [friday])) == 1
+
+  def test_find_page_hits_negative_zero(self):
+    # A centicule and a radius covering the same point in a '-0' graticule should only be reported once
+    day = datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+    geohashes = main.GeohashTable({'2019-12-31': '28414.64', '2020-01-02': '28638.97'}, [day])
+    config = main.parse_config('| -0 || 100 || 72 || || radius=10km@-0.79/100.21, Email')
+    hits = main.find_page_hits(config, geohashes, [day])
+    assert list(hits) == [(day, '-0', '100')]
+    _, order, graticule, _, notifications, distance = hits[(day, '-0', '100')]
+    assert (order, graticule, distance) == ((0, 0), ('-0', '100'), None)
+    assert notifications == {'config_page': True, 'email': True}
+
+  def test_globalhash_negative_zero(self):
+    # '-0' and '0' are different graticules, on opposite sides of the equator (or prime meridian)
+    config = main.parse_config('| -0 || -0 || || || Globalhash\n| 0 || 5 || 12 || ||')
+    assert list(config.globalhash.graticules) == [('-0', '-0')]
+    assert list(config.graticules) == [('0', '5')]
+    # Graticules can be looked up as ints too, but only '-0' names the -0 graticule
+    assert (0, 5) in config['monday'] and ('0', '5') in config['monday']
+    negative = main.parse_config('| -0 || 5 || 12 || ||')
+    assert ('-0', '5') in negative['monday'] and (0, 5) not in negative['monday']
+    assert negative['monday'] == {('-0', '5'): {'12': {'config_page': True}}}
+    assert negative['monday'] != {(0, 5): {'12': {'config_page': True}}}
+
+    class Globalhashes:
+      def __init__(self, globalhash):
+        self.globalhash = globalhash
+      def has(self, day, w30):
+        return not w30
+      def get(self, day, w30):
+        return main.Geohash('0', '0', '00', '0')
+      def get_global(self, day):
+        return self.globalhash
+
+    day = datetime.datetime(2020, 1, 6, tzinfo=datetime.timezone.utc) # monday
+    assert list(main.find_page_hits(config, Globalhashes(main.Globalhash(-0.5, -0.5, ('-0', '-0'), '55')), [day])) == [(day, 'global')]
+    assert main.find_page_hits(config, Globalhashes(main.Globalhash(0.5, 0.5, ('0', '0'), '55')), [day]) == {}
+
+  def test_globalhash(self):
+    day = datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+    table = main.GeohashTable({'2019-12-31': '28414.64', '2020-01-02': '28638.97'}, [day])
+    globalhash = table.get_global(day)
+    assert abs(globalhash.latitude - 53.282608) < 1e-6
+    assert abs(globalhash.longitude - -101.031316) < 1e-6
+    assert globalhash.graticule == ('53', '-101')
+    assert globalhash.centicule == '20'
+
+  def test_get_targets(self):
+    thursday = datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc)
+    friday = datetime.datetime(2020, 1, 3, 13, 30, tzinfo=datetime.timezone.utc)
+    def dates(targets):
+      return [(day.strftime('%Y-%m-%d'), w30) for day, w30 in targets]
+
+    assert dates(main.get_targets(thursday)) == [('2020-01-02', True), ('2020-01-02', False)]
+    assert dates(main.get_targets(thursday, lookahead=True)) == [('2020-01-02', True), ('2020-01-02', False), ('2020-01-03', False)]
+    friday_targets = dates(main.get_targets(friday, lookahead=True))
+    assert len(friday_targets) == 7 # W30 and E30 for the weekend, plus E30 for Monday
+    assert friday_targets[-1] == ('2020-01-06', False)
+
+    # Before the 30W rule, every hash uses that day's open, so there's nothing to look ahead to.
+    old = datetime.datetime(2008, 5, 16, 13, 30, tzinfo=datetime.timezone.utc)
+    assert len(main.get_targets(old, lookahead=True)) == 6
+
+    # The next trading day only has an E30 hash, which still includes the globalhash
+    table = main.GeohashTable({'2020-01-02': '28638.97'}, targets=main.get_targets(thursday, lookahead=True)[2:])
+    assert not table.has(friday, True)
+    assert table.get(friday, False).centicule == '20'
+    assert table.get_global(friday)
+
+  def test_dow_history(self):
+    path = os.path.join(tempfile.mkdtemp(), 'dow_history.bin')
+    with dow_history.DowHistory(path) as history:
+      assert history.get('2024-05-01') is None
+      assert history.update(self.dow_opens) == len(self.dow_opens)
+      assert history.update(self.dow_opens) == 0
+      assert not history.add('2024-05-01', '1.00') # Existing values are never overwritten
+      assert not history.add('2024-05-08', '38884.26000') # Only exact cents can be stored
+      assert not history.add('1900-01-01', '100.00')
+
+    # Reopen to make sure everything was persisted
+    with dow_history.DowHistory(path) as history:
+      for date, dow in self.dow_opens.items():
+        assert history.get(date) == dow
+      assert history.get('2024-04-30') == '38337.40'
+      assert '2024-05-04' not in history
+      assert '2099-01-01' not in history
+
+      # The history is a drop-in replacement for the dow_opens dictionary
+      day = datetime.datetime(2024, 5, 6, tzinfo=datetime.timezone.utc)
+      assert main.GeohashTable(history, [day]).get(day, w30 = False)[:3] == main.get_geohash(self.dow_opens, day, w30 = False)
+
+    assert os.path.getsize(path) == dow_history.HEADER.size + 4 * (datetime.date(2024, 5, 7) - dow_history.EPOCH).days + 4
+
+  def test_server(self):
+    history = dow_history.DowHistory(os.path.join(tempfile.mkdtemp(), 'dow_history.bin'))
+    history.update({'2019-12-31': '28414.64', '2020-01-02': '28638.97'})
+    geohash_server = server.GeohashServer(('127.0.0.1', 0), history)
+    threading.Thread(target=geohash_server.serve_forever, daemon=True).start()
+    def get(path):
+      try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{geohash_server.server_address[1]}{path}') as response:
+          return response.status, json.load(response)
+      except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+    try:
+      status, body = get('/geohash?date=2020-01-02&lat=0&lon=-100')
+      assert status == 200
+      assert body['latitude'] == 0.15412936177081613
+      assert body['longitude'] == -100.21669788487512565
+      assert body['centicule'] == '12'
+      assert get('/geohash?date=2020-01-02&lat=-0&lon=100')[1]['latitude'] == -0.7960144915143538
+      assert get('/centicule?date=2020-01-02&lon=100')[1]['centicule'] == '72'
+      assert get('/globalhash?date=2020-01-02')[1]['graticule'] == ['53', '-101']
+
+      assert get('/geohash?date=2020-01-02&lat=0') == (400, {'error': 'Missing parameter: lon'})
+      assert get('/geohash?date=2020-02-30&lat=0&lon=0')[0] == 400
+      assert get('/geohash?date=0001-01-01&lat=0&lon=0')[0] == 400
+      assert get(f'/globalhash?date={dow_history.EPOCH - datetime.timedelta(days=1)}')[0] == 400
+      assert get('/nothing')[0] == 404
+      # The open for the 3rd isn't known yet, so this shouldn't fall back to an older one
+      assert get('/geohash?date=2020-01-03&lat=0&lon=-100')[0] == 404
+
+      # ... until the daily run adds it (from another process, in real life)
+      with dow_history.DowHistory(history.path) as other:
+        other.add('2020-01-03', '28634.88')
+      assert get('/geohash?date=2020-01-03&lat=0&lon=-100')[0] == 200
+      assert geohash_server.service.get_geohash.cache_info().hits > 0
+    finally:
+      geohash_server.shutdown()
+      geohash_server.server_close()
+      history.close()
+
+  def test_replay(self):
+    history = dow_history.DowHistory(os.path.join(tempfile.mkdtemp(), 'dow_history.bin'))
+    history.update({'2019-12-31': '28414.64', '2020-01-02': '28638.97'})
+    geohash_server = server.GeohashServer(('127.0.0.1', 0), history)
+    threading.Thread(target=geohash_server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{geohash_server.server_address[1]}'
+    path = os.path.join(tempfile.mkdtemp(), 'fixture.json.gz')
+
+    try:
+      recorder = replay.install('record', path, today='2020-01-02')
+      text = dow_jones.get_url(f'{base}/centicule?date=2020-01-02&lon=100')
+      chunks = ''.join(dow_jones.stream_url(f'{base}/globalhash?date=2020-01-02'))
+      login = requests.post(f'{base}/api.php', data={'action': 'login', 'lgpassword': 'hunter2'})
+      recorder.save()
+    finally:
+      replay.uninstall()
+      geohash_server.shutdown()
+      geohash_server.server_close()
+      history.close()
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+      assert 'hunter2' not in f.read()
+
+    # The server is gone, so these can only come from the fixture
+    dow_jones.validators.clear()
+    replayer = replay.install('replay', path)
+    try:
+      assert replayer.metadata == {'today': '2020-01-02'}
+      assert dow_jones.get_url(f'{base}/centicule?date=2020-01-02&lon=100') == text
+      assert ''.join(dow_jones.stream_url(f'{base}/globalhash?date=2020-01-02')) == chunks
+      assert requests.post(f'{base}/api.php', data={'action': 'login', 'lgpassword': 'other'}).status_code == login.status_code
+      try:
+        dow_jones.get_url(f'{base}/centicule?date=2020-01-03&lon=100')
+        assert False, 'Request was not recorded, so it should fail'
+      except requests.ConnectionError:
+        pass
+      assert len(replayer.misses) == 1
+    finally:
+      replay.uninstall()
+
+  def test_replay_end2end(self):
+    # Record a run which had to poll twice before the open was out, then replay it, which shouldn't wait between polls
+    pages = {
+      'https://markets.businessinsider.com/index/dow_jones?op=1': [
+        'historicalPrices: {"model": [{"Date": "12/31/19", "Open": 28414.64}]}\n',
+        'historicalPrices: {"model": [{"Date": "01/02/20", "Open": 28638.97}, {"Date": "12/31/19", "Open": 28414.64}]}\n',
+      ],
+      'https://markets.ft.com/data/indices/tearsheet/historical?s=DJI:DJI': [
+        '<table><tr><td><span>Tuesday, December 31, 2019</span><span>Tue, Dec 31</span></td><td>28,414.64</td></tr></table>',
+        '<table><tr><td><span>Thursday, January 02, 2020</span><span>Thu, Jan 02</span></td><td>28,638.97</td></tr>'
+        '<tr><td><span>Tuesday, December 31, 2019</span><span>Tue, Dec 31</span></td><td>28,414.64</td></tr></table>',
+      ],
+    }
+    polls = collections.Counter()
+    def network(session, request, **kwargs):
+      responses = pages[request.url]
+      content = responses[min(polls[request.url], len(responses) - 1)]
+      polls[request.url] += 1
+      entry = {'status': 200, 'reason': 'OK', 'headers': {'Content-Type': 'text/html; charset=utf-8'}, 'content': base64.b64encode(content.encode('utf-8')).decode('ascii')}
+      return replay.from_entry(entry, request)
+
+    def run(wiki, today):
+      page = MockPage(wiki, 'category_page')
+      page.wikitext = '| 0 || -100 || 12'
+      wiki.category_pages = [page]
+      main.main(wiki, today)
+      return page.wikitext
+
+    dow_jones.dow_sources = [dow_jones.dow_from_businessinsider, dow_jones.dow_from_financialtimes]
+    today = datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc)
+    path = os.path.join(tempfile.mkdtemp(), 'fixture.json.gz')
+    original_send, Dispatcher = replay.original_send, dispatch.Dispatcher
+    try:
+      replay.original_send = network
+      dow_jones.clock = replay.ReplayClock() # The recorded run waits a minute between polls
+      recorder = replay.install('record', path, today=today.isoformat())
+      recorded = run(MockWiki(), today)
+      recorder.save()
+      replay.original_send = original_send
+      replay.uninstall()
+      assert polls == {url: 2 for url in pages}
+      assert dow_jones.clock.monotonic() >= 60
+
+      dow_jones.validators.clear()
+      dow_jones.last_rows.clear()
+      dow_jones.clock = time
+      replayer = main.install_replay(path)
+      start = time.time()
+      replayed = run(MockWiki(), datetime.datetime.fromisoformat(replayer.metadata['today']))
+      assert time.time() - start < 10
+      assert replayed == recorded
+      assert '[https://edit.url/2020-01-02_0_-100 2020-01-02 0 -100]' in replayed
+      assert replayer.misses == []
+      assert polls == {url: 2 for url in pages} # Nothing went to the network
+    finally:
+      replay.original_send = original_send
+      replay.uninstall()
+      dow_jones.clock = time
+      dispatch.Dispatcher = Dispatcher
+      dow_jones.validators.clear()
+
+  def test_page_cache(self):
+    wiki = MockWiki()
+    page1 = MockPage(wiki, 'User:A/Foo')
+    page1.wikitext = '| 47 || -122 || 50 51 || || Email, Saturday'
+    page2 = MockPage(wiki, 'User:B/Bar')
+    page2.wikitext = '| 1 || 2 || 03 || ||'
+    wiki.category_pages = [page1, page2]
+
+    path = os.path.join(tempfile.mkdtemp(), 'page_cache.json')
+    cache = page_cache.PageCache(path)
+    entries = cache.fetch(wiki, ['User:A/Foo', 'User:B/Bar', 'User:C/Missing'])
+    assert entries[2] is None
+    assert [(title, text, value) for title, _, text, value in entries[:2]] == [('User:A/Foo', page1.wikitext, None), ('User:B/Bar', page2.wikitext, None)]
+    for title, revid, text, _ in entries[:2]:
+      cache.set(title, revid, main.config_to_json(main.parse_config(text)))
+    cache.save()
+
+    # Only the edited page is downloaded again, and the other one comes back with its cached value
+    page2.edit('| 1 || 2 || 04 || ||')
+    wiki.queries.clear()
+    cache = page_cache.PageCache(path)
+    entries = cache.fetch(wiki, ['User:A/Foo', 'User:B/Bar'])
+    assert [query['rvprop'] for query in wiki.queries] == ['ids', 'ids|content']
+    assert wiki.queries[1]['titles'] == 'User:B/Bar'
+    assert entries[0][2] is None # Only the parsed config is kept
+    assert main.config_from_json(entries[0][3]) == main.parse_config(page1.wikitext)
+    assert entries[1][2:] == ('| 1 || 2 || 04 || ||', None)
+    with open(path, 'r', encoding='utf-8') as f:
+      assert 'Email, Saturday' not in f.read()
+
+  def test_dispatch(self):
+    log = []
+    def make_job(key, name, results):
+      results = list(results)
+      def run():
+        log.append(name)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+          raise result
+        return result
+      return dispatch.Job(key, name, run)
+
+    jobs = [
+      make_job('A', 'a1', [{'error': {'code': 'maxlag', 'info': 'Waiting for a database server', 'lag': 0.01}}, 'ok a1']),
+      make_job('A', 'a2', ['ok a2']),
+      make_job('B', 'b1', [ValueError('Not retryable')]),
+      make_job('B', 'b2', ['ok b2']),
+      make_job('C', 'c1', [dispatch.Retry('Try again'), dispatch.Retry('Try again'), 'ok c1']),
+    ]
+    dispatcher = dispatch.Dispatcher(workers=3, rate=1000, burst=10, retries=3, backoff=0.01)
+    results = dispatcher.dispatch(jobs)
+    assert [job.description for job, _ in results] == ['a1', 'a2', 'b1', 'c1'] # b2 is skipped after b1 fails
+    assert [result for _, result in results if not isinstance(result, Exception)] == ['ok a1', 'ok a2', 'ok c1']
+    assert isinstance(results[2][1], ValueError)
+    assert log.index('a2') > log.index('a1')
+    assert log.count('a1') == 2 and log.count('c1') == 3
+
+    # The delay comes from the response's Retry-After header, not the replication lag in the error
+    class Response:
+      def __init__(self, headers, body):
+        self.headers, self.body = headers, body
+      def json(self):
+        return self.body
+    maxlag = {'error': {'code': 'maxlag', 'info': 'Waiting for a database server: 7 seconds lagged', 'lag': 7}}
+    for result, retry_after in [
+      (Response({'Content-Type': 'application/json; charset=utf-8', 'Retry-After': '5'}, maxlag), 5),
+      (Response({'Content-Type': 'application/json; charset=utf-8'}, maxlag), None),
+      (maxlag, None),
+    ]:
+      try:
+        dispatch.check_result(result)
+        assert False, 'Should have raised'
+      except dispatch.Retry as e:
+        assert e.retry_after == retry_after
+    ok = Response({'Content-Type': 'application/json'}, {'edit': {'result': 'Success'}})
+    assert dispatch.check_result(ok) is ok
+
+    # Too many retries
+    results = dispatcher.dispatch([make_job('A', 'a', [dispatch.Retry('Try again')] * 5)])
+    assert isinstance(results[0][1], dispatch.Retry)
+
+    # Rate limiting, 10 jobs at 50/second with a burst of 5 should take ~0.1 seconds
+    dispatcher = dispatch.Dispatcher(workers=10, rate=50, burst=5)
+    start = time.time()
+    dispatcher.dispatch([make_job(i, i, [None]) for i in range(10)])
+    assert 0.08 < time.time() - start < 0.5
+
   def test_end2end(self):
     dow_opens = [(datetime.datetime(2019, 12, 31), '28414.64'), (datetime.datetime(2020, 1, 2), '28638.97')]
     dow_jones.dow_sources = [lambda: dow_opens] * 3
@@ -203,6 +968,23 @@ class Tests:
     ])
     assert page.wikitext == expected
 
+  def test_end2end_concurrent_edit(self):
+    wiki = MockWiki()
+    page = MockPage(wiki, 'category_page')
+    page.wikitext = '| 0 || -100 || 12'
+    wiki.category_pages = [page]
+    get = wiki.get
+    def get_then_edit(action, **kwargs):
+      result = get(action, **kwargs)
+      if 'content' in kwargs['rvprop']:
+        page.edit(page.wikitext + '\n| 1 || 2 || 34 || ||') # The user edits their page while the bot is running
+      return result
+    wiki.get = get_then_edit
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+
+    # The bot's edit goes on top of the user's, instead of reverting it
+    assert page.wikitext.startswith('| 0 || -100 || 12\n| 1 || 2 || 34 || ||\n=== [https://edit.url/2020-01-02_0_-100')
+
   def test_end2end_30w(self):
     dow_opens = [(datetime.datetime(2019, 12, 31), '28414.64'), (datetime.datetime(2020, 1, 2), '28638.97')]
     dow_jones.dow_sources = [lambda: dow_opens] * 3
@@ -226,6 +1008,213 @@ class Tests:
     ])
     assert page.wikitext == expected
 
+  def test_end2end_coalesce_users(self):
+    wiki = MockWiki()
+    pages = [MockPage(wiki, 'User:A/Foo'), MockPage(wiki, 'User:A/Bar'), MockPage(wiki, 'User:B/Baz')]
+    pages[0].wikitext = '| 0 || -100 || 12 || || Talkpage, Email'
+    pages[1].wikitext = '| 0 || 100 || 72 || || Talkpage, Email'
+    pages[2].wikitext = '| 0 || -100 || 12 || || Talkpage'
+    wiki.category_pages = pages
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+
+    edited = sorted(title for title, _ in wiki.edits)
+    assert edited == ['User talk:A', 'User talk:B', 'User:A/Bar', 'User:A/Foo', 'User:B/Baz']
+    talk_a = dict(wiki.edits)['User talk:A']
+    assert talk_a == '\n'.join([
+      'default for User talk:A',
+      '== New geohashing site on 2020-01-02 ==',
+      'See [[User:A/Foo]]',
+      '',
+      '== New geohashing site on 2020-01-02 ==',
+      'See [[User:A/Bar]]',
+    ])
+    assert len(wiki.emails) == 1
+    assert wiki.emails[0][0] == 'User:A'
+    assert wiki.emails[0][1].count('<h2>') == 2
+    assert wiki.maxlags == [dispatch.MAXLAG] * 6
+
+  def test_end2end_radius(self):
+    # The W30 geohash for 2020-01-02 is at (0.154, -100.217), in centicule 12
+    wiki = MockWiki()
+    pages = [MockPage(wiki, 'User:A/Near'), MockPage(wiki, 'User:B/Far'), MockPage(wiki, 'User:C/Both')]
+    pages[0].wikitext = '| 1 || -101 || || || radius=50km@0.5/-100.5, Email'
+    pages[1].wikitext = '| 1 || -101 || || || radius=20km@0.5/-100.5'
+    pages[2].wikitext = '| 0 || -100 || 12 || ||\n| 0 || -100 || || || radius=30km@0.1/-100.1, Talkpage'
+    wiki.category_pages = pages
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+
+    edits = dict(wiki.edits)
+    assert sorted(edits) == ['User talk:C', 'User:A/Near', 'User:C/Both']
+    assert '2020-01-02 0 -100' in edits['User:A/Near']
+    assert 'km from home' in edits['User:A/Near']
+    # Only reported once, as a centicule hit, but with the notifications from both lines
+    assert edits['User:C/Both'].count('2020-01-02 0 -100') == 1
+    assert 'Centicule 12' in edits['User:C/Both']
+    assert len(wiki.emails) == 1
+    assert 'km from home' in wiki.emails[0][1]
+
+  def test_end2end_lookahead(self):
+    dow_opens = [(datetime.datetime(2019, 12, 31), '28414.64'), (datetime.datetime(2020, 1, 2), '28638.97'), (datetime.datetime(2020, 1, 3), '28634.88')]
+    dow_jones.dow_sources = [lambda: dow_opens] * 3
+
+    wiki = MockWiki()
+    page = MockPage(wiki, 'category_page')
+    page.wikitext = '| 0 || 100 || 20'
+    wiki.category_pages = [page]
+
+    # Thursday's open already fixes Friday's E30 hash, so it's reported a day early
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc), lookahead=True)
+    assert '=== [https://edit.url/2020-01-03_0_100 2020-01-03 0 100] ===' in page.wikitext
+
+    # ...and not again on Friday
+    main.main(wiki, datetime.datetime(2020, 1, 3, 13, 30, tzinfo=datetime.timezone.utc), lookahead=True)
+    assert page.wikitext.count('2020-01-03 0 100') == 1
+
+  def test_end2end_globalhash(self):
+    # The globalhash for 2020-01-02 is at (53.283, -101.031)
+    wiki = MockWiki()
+    pages = [MockPage(wiki, 'User:A/Global'), MockPage(wiki, 'User:B/Elsewhere'), MockPage(wiki, 'User:C/Nearby')]
+    pages[0].wikitext = '| 53 || -101 || || || Globalhash, Talkpage'
+    pages[1].wikitext = '| 53 || -101 || 21 || || Globalhash'
+    pages[2].wikitext = '| 0 || 0 || || || Globalhash, radius=100km@53.5/-100.5'
+    wiki.category_pages = pages
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+
+    edits = dict(wiki.edits)
+    assert sorted(edits) == ['User talk:A', 'User:A/Global', 'User:C/Nearby']
+    assert '2020-01-02 global' in edits['User:A/Global']
+    assert 'Graticule 53 -101, centicule 20' in edits['User:A/Global']
+    assert 'km from home' in edits['User:C/Nearby']
+    assert '== New globalhash on 2020-01-02 ==' in edits['User talk:A']
+
+  def test_lazy_imports(self):
+    # Days when the market is closed should exit without loading the wiki client or requests
+    code = '; '.join([
+      'import datetime, sys, main',
+      'main.main(None, datetime.datetime(2024, 5, 4, 13, 30))',
+      'print(sorted(name for name in sys.modules if name == "requests" or "wikitools" in name or name == "zoneinfo"))',
+    ])
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)}
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]', result.stdout
+
+  def test_instrumentation(self):
+    instrumentation.reset()
+    with instrumentation.timer('outer'):
+      with instrumentation.timer('inner'):
+        instrumentation.count('things', 2)
+      with instrumentation.timer('inner'):
+        instrumentation.count('things')
+    instrumentation.observe('latency', 0.5)
+    instrumentation.observe('latency', 0.1)
+
+    summary = instrumentation.summary()
+    assert sorted(summary['timers']) == ['outer', 'outer/inner']
+    assert summary['timers']['outer/inner']['calls'] == 2
+    assert summary['counters'] == {'things': 3}
+    assert summary['latencies']['latency'] == {'count': 2, 'mean': 0.3, 'p50': 0.5, 'max': 0.5}
+
+    # A full run records each phase, and the per-source fetch latency
+    instrumentation.reset()
+    wiki = MockWiki()
+    wiki.category_pages = [MockPage(wiki, 'User:A/Foo'), MockPage(wiki, 'User:B/Bar')]
+    wiki.category_pages[0].wikitext = '| 0 || -100 || 12 || || Email'
+    main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+
+    summary = instrumentation.summary()
+    assert {'dow_jones', 'hash', 'pipeline', 'pipeline.fetch', 'pipeline.parse', 'pipeline.match', 'pipeline.render', 'dispatch'} <= set(summary['timers'])
+    assert summary['counters']['pages_tracked'] == 2
+    assert summary['counters']['pages_parsed'] == 2
+    assert summary['counters']['hits'] == 1
+    assert summary['counters']['edits'] == 1
+    assert summary['counters']['emails'] == 1
+    assert summary['latencies']['dow_jones.fetch.<lambda>']['count'] >= 2
+
+  def test_pipeline(self):
+    def slow_square(x):
+      time.sleep(0.01 * (x % 3)) # Finish out of order
+      return x * x
+    batches = []
+    def add_one(batch):
+      batches.append(len(batch))
+      return [x + 1 for x in batch]
+    stages = [pipeline.Stage('add', add_one, workers=2, batch_size=4), pipeline.Stage('square', slow_square, workers=4)]
+    assert list(pipeline.run(range(20), stages, queue_size=3)) == [(x + 1) ** 2 for x in range(20)]
+    assert sum(batches) == 20 and max(batches) <= 4
+
+    def fail_on_5(x):
+      if x == 5:
+        raise ValueError(x)
+      return x
+    results = []
+    try:
+      for result in pipeline.run(range(10), [pipeline.Stage('fail', fail_on_5, workers=3)]):
+        results.append(result)
+      assert False, 'Should have raised'
+    except ValueError:
+      pass
+    assert results == [0, 1, 2, 3, 4]
+
+    # The same run, with parsing on a process pool, makes exactly the same edits
+    def run(threshold):
+      main.DOW_HISTORY_PATH = os.path.join(tempfile.mkdtemp(), 'dow_history.bin')
+      main.PAGE_CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'page_cache.json')
+      main.RUN_JOURNAL_PATH = os.path.join(tempfile.mkdtemp(), 'run_journal.jsonl')
+      main.PARSE_PROCESS_THRESHOLD = threshold
+      wiki = MockWiki()
+      for i in range(6):
+        page = MockPage(wiki, f'User:U{i % 2}/Page {i}')
+        page.wikitext = f'| 0 || {-100 if i % 2 else 100} || {i:02} 12 72 || || {"Talkpage" if i % 3 else ""}'
+        wiki.category_pages.append(page)
+      main.main(wiki, datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc))
+      return sorted(wiki.edits), sorted(wiki.emails)
+    try:
+      assert run(threshold=0) == run(threshold=10000)
+    finally:
+      main.PARSE_PROCESS_THRESHOLD = 2000
+
+  def test_end2end_resume(self):
+    dow_opens = [(datetime.datetime(2019, 12, 31), '28414.64'), (datetime.datetime(2020, 1, 2), '28638.97')]
+    dow_jones.dow_sources = [lambda: dow_opens] * 3 # Updated below
+
+    wiki = MockWiki()
+    pages = [MockPage(wiki, 'User:A/Foo'), MockPage(wiki, 'User:B/Bar'), MockPage(wiki, 'User:C/Baz')]
+    pages[0].wikitext = '| 0 || -100 || 12 || || Talkpage, Email'
+    pages[1].wikitext = '| 0 || 100 || 72 || || Talkpage'
+    pages[2].wikitext = '| 0 || 100 || 00'
+    wiki.category_pages = pages
+
+    def email_user(user, title, contents, **kwargs):
+      raise ValueError('Email server is down')
+    wiki.email_user = email_user
+    today = datetime.datetime(2020, 1, 2, 13, 30, tzinfo=datetime.timezone.utc)
+    try:
+      main.main(wiki, today)
+      assert False, 'The run should fail, so that it gets retried'
+    except SystemExit as e:
+      assert e.code == 1
+    assert sorted(title for title, _ in wiki.edits) == ['User talk:A', 'User talk:B', 'User:A/Foo', 'User:B/Bar']
+    assert not os.path.exists(main.HASH_COVERAGE_PATH) # Nothing counts as reported until the run succeeds
+
+    # The retry should only send the email, and not edit any pages again
+    wiki.edits.clear()
+    del wiki.email_user
+    main.main(wiki, today)
+    assert wiki.edits == []
+    assert [user for user, _ in wiki.emails] == ['User:A']
+
+    # And a third run has nothing left to do
+    wiki.emails.clear()
+    main.main(wiki, today)
+    assert wiki.edits == [] and wiki.emails == []
+
+    # But the next day starts from scratch
+    pages[0].wikitext = '| 0 || -100 || 12'
+    dow_opens.append((datetime.datetime(2020, 1, 3), '28553.33'))
+    main.main(wiki, today + datetime.timedelta(days=1))
+    with open(main.RUN_JOURNAL_PATH) as f:
+      assert all('2020-01-03' in line for line in f)
+
 if __name__ == '__main__':
   test_class = Tests()
 
@@ -240,6 +1229,15 @@ if __name__ == '__main__':
         continue
 
     # Test setup
+    dow_jones.health = source_health.SourceHealth()
+    main.HASH_COVERAGE_PATH = os.path.join(tempfile.mkdtemp(), 'hash_coverage.json')
+    main.SOURCE_HEALTH_PATH = os.path.join(tempfile.mkdtemp(), 'source_health.json')
+    main.DOW_HISTORY_PATH = os.path.join(tempfile.mkdtemp(), 'dow_history.bin')
+    main.PAGE_CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'page_cache.json')
+    main.RUN_JOURNAL_PATH = os.path.join(tempfile.mkdtemp(), 'run_journal.jsonl')
+    main.Page = MockPage
+    # The opens most of the end2end tests use
+    dow_jones.dow_sources = [lambda: [(datetime.datetime(2019, 12, 31), '28414.64'), (datetime.datetime(2020, 1, 2), '28638.97')]] * 3
 
     # Run test
     print('---', test[0], 'started')